@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+
+import os
+import bz2
+import time
+import random
+import hashlib
+import multiprocessing
+import tempfile
+from optparse import OptionParser
+from mbslave.bzip2 import ParallelBZ2Reader, ExternalBZ2Reader, find_program
+
+
+def generate_file(size):
+    # Text similar to dump data, compressing to several bzip2 blocks per MB
+    rng = random.Random(0)
+    words = ['artist', 'release', 'recording', 'The', 'of', 'Love', 'Night', '\\N', '2012-01-01', '\t', '\n']
+    tmp = tempfile.NamedTemporaryFile(suffix='.bz2')
+    compressor = bz2.BZ2Compressor(9)
+    written = 0
+    while written < size:
+        chunk = ' '.join(rng.choice(words) + str(rng.randint(0, 100000)) for i in range(10000))
+        tmp.write(compressor.compress(chunk))
+        written += len(chunk)
+    tmp.write(compressor.flush())
+    tmp.flush()
+    return tmp
+
+
+def read_builtin(fileobj):
+    return bz2.BZ2File(fileobj.name)
+
+
+def measure(name, open_reader, path):
+    with open(path, 'rb') as fileobj:
+        start = time.time()
+        reader = open_reader(fileobj)
+        checksum = hashlib.md5()
+        size = 0
+        while True:
+            data = reader.read(1024 * 1024)
+            if not data:
+                break
+            checksum.update(data)
+            size += len(data)
+        reader.close()
+        elapsed = time.time() - start
+    compressed_size = os.path.getsize(path)
+    print '%-10s %8.1f s %10.1f MB/s in %10.1f MB/s out  %s' % (
+        name, elapsed, compressed_size / elapsed / 1024 / 1024, size / elapsed / 1024 / 1024, checksum.hexdigest())
+    return checksum.hexdigest()
+
+
+parser = OptionParser(usage="%prog [options] [FILE.bz2]")
+parser.add_option("-j", "--workers", dest="workers", type="int", default=multiprocessing.cpu_count(), help="number of decompression processes")
+parser.add_option("-s", "--size", dest="size", type="int", default=200, help="MB of synthetic data to generate if no file is given")
+options, args = parser.parse_args()
+
+if args:
+    path = args[0]
+else:
+    tmp = generate_file(options.size * 1024 * 1024)
+    path = tmp.name
+
+checksums = set()
+checksums.add(measure('builtin', read_builtin, path))
+checksums.add(measure('parallel', lambda fileobj: ParallelBZ2Reader(fileobj, options.workers), path))
+program = find_program()
+if program:
+    checksums.add(measure(os.path.basename(program), lambda fileobj: ExternalBZ2Reader(fileobj, program, options.workers), path))
+
+if len(checksums) != 1:
+    print 'Decompressed data differs between backends'
+    raise SystemExit(1)
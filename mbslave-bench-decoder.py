@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+
+import re
+import random
+import time
+from optparse import OptionParser
+from cStringIO import StringIO
+from mbslave.dbmirror import read_psql_dump, parse_data_fields, format_data_fields, parse_bool, escape
+
+
+# The decoder used by mbslave-sync.py before mbslave.dbmirror, kept as the baseline
+
+def legacy_parse_data_fields(s):
+    fields = {}
+    for name, value in re.findall(r'''"([^"]+)"=('(?:''|[^'])*')? ''', s):
+        if not value:
+            value = None
+        else:
+            value = value[1:-1].replace("''", "'").replace("\\\\", "\\")
+        fields[name] = value
+    return fields
+
+
+LEGACY_ESCAPES = (('\\b', '\b'), ('\\f', '\f'), ('\\n', '\n'), ('\\r', '\r'),
+                  ('\\t', '\t'), ('\\v', '\v'), ('\\\\', '\\'))
+
+def legacy_unescape(s):
+    if s == '\\N':
+        return None
+    for orig, repl in LEGACY_ESCAPES:
+        s = s.replace(orig, repl)
+    return s
+
+
+def legacy_read_psql_dump(fp, types):
+    for line in fp:
+        values = map(legacy_unescape, line.rstrip('\r\n').split('\t'))
+        for i, value in enumerate(values):
+            if value is not None:
+                values[i] = types[i](value)
+        yield values
+
+
+TABLES = ['"musicbrainz"."artist"', '"musicbrainz"."recording"', '"musicbrainz"."edit"',
+          '"musicbrainz"."edit_data"', '"musicbrainz"."tag"', '"statistics"."statistic"']
+
+COLUMNS = ['id', 'gid', 'name', 'sort_name', 'comment', 'edits_pending', 'last_updated', 'data']
+
+PLAIN_CHARS = u'abcdefghijklmnopqrstuvwxyz ABCDEF0123456789\xe9\xfc\u3042'
+SPECIAL_CHARS = PLAIN_CHARS + u'\'"\\\t\n\r\b\f\v'
+
+
+def random_value(rng, special):
+    if rng.random() < 0.1:
+        return None
+    if rng.random() < special:
+        chars = SPECIAL_CHARS
+    else:
+        chars = PLAIN_CHARS
+    return u''.join(rng.choice(chars) for i in range(rng.randint(0, 40))).encode('utf8')
+
+
+def generate_packet(rows, special, seed):
+    rng = random.Random(seed)
+    pending = []
+    pending_data = []
+    expected = []
+    for id in range(1, rows + 1):
+        type = rng.choice('iud')
+        pending.append('%d\t%s\t%s\t%d\n' % (id, rng.choice(TABLES), type, id // 10))
+        records = []
+        if type in 'ud':
+            records.append((True, [('id', str(id))]))
+        if type in 'iu':
+            records.append((False, [(name, random_value(rng, special)) for name in COLUMNS]))
+        for key, fields in records:
+            pending_data.append('%d\t%s\t%s\n' % (id, 't' if key else 'f', escape(format_data_fields(fields))))
+            expected.append([id, key, dict(fields)])
+    return ''.join(pending), ''.join(pending_data), expected
+
+
+def measure(func, data, types, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for row in func(StringIO(data), types):
+            pass
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+parser = OptionParser(usage="%prog [options]")
+parser.add_option("-n", "--rows", dest="rows", type="int", default=100000, help="number of changes in the synthetic packet")
+parser.add_option("-s", "--special", dest="special", type="float", default=0.1, help="fraction of values with quotes, backslashes and control characters")
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="number of runs, the best one is reported")
+parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+options, args = parser.parse_args()
+
+pending, pending_data, expected = generate_packet(options.rows, options.special, options.seed)
+
+pending_types = [int, str, str, int]
+pending_data_types = [int, parse_bool, parse_data_fields]
+legacy_pending_data_types = [int, parse_bool, legacy_parse_data_fields]
+
+# The new decoder must return exactly the values that were encoded. The old
+# one is allowed to differ only where it decodes escaped backslashes wrong.
+decoded = list(read_psql_dump(StringIO(pending_data), pending_data_types))
+if decoded != expected:
+    print 'Decoded PendingData does not match the generated values'
+    raise SystemExit(1)
+if list(read_psql_dump(StringIO(pending), pending_types)) != list(legacy_read_psql_dump(StringIO(pending), pending_types)):
+    print 'Decoded Pending does not match the old decoder'
+    raise SystemExit(1)
+legacy_decoded = list(legacy_read_psql_dump(StringIO(pending_data), legacy_pending_data_types))
+mismatched = sum(1 for a, b in zip(decoded, legacy_decoded) if a != b)
+print 'Verified %d PendingData rows, %d decoded differently by the old decoder (escaped backslashes)' % (len(decoded), mismatched)
+
+print '%-12s %-8s %12s %12s' % ('file', 'decoder', 'rows/sec', 'MB/sec')
+for name, data, old_types, new_types in [
+        ('Pending', pending, pending_types, pending_types),
+        ('PendingData', pending_data, legacy_pending_data_types, pending_data_types)]:
+    lines = data.count('\n')
+    for decoder, func, types in [('old', legacy_read_psql_dump, old_types), ('new', read_psql_dump, new_types)]:
+        elapsed = measure(func, data, types, options.repeat)
+        print '%-12s %-8s %12d %12.1f' % (name, decoder, lines / elapsed, len(data) / elapsed / 1024 / 1024)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python2
+
+import os
+import time
+import shutil
+import random
+import urllib2
+import tempfile
+import threading
+import BaseHTTPServer
+from optparse import OptionParser
+from mbslave.packets import PacketPrefetcher, download_packet, packet_name
+
+
+class PacketHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves replication-N.tar.bz2 files from a directory like the
+    # replication server, with a delay and optional failures
+
+    def do_GET(self):
+        name = self.path.split('?')[0].lstrip('/')
+        seq = int(name.split('-')[1].split('.')[0])
+        self.server.requests.append(seq)
+        time.sleep(self.server.delay)
+        path = os.path.join(self.server.packet_dir, name)
+        failure = self.server.failures.get(seq)
+        if failure == 'error':
+            self.send_error(500)
+            return
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        data = open(path, 'rb').read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if failure == 'truncate':
+            data = data[:len(data) // 2]
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(packet_dir, delay):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PacketHandler)
+    server.packet_dir = packet_dir
+    server.delay = delay
+    server.requests = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def generate_packets(packet_dir, first, count, size, seed):
+    rng = random.Random(seed)
+    packets = {}
+    for seq in range(first, first + count):
+        data = 'packet %d\n' % seq + ''.join(chr(rng.getrandbits(8)) for i in range(size))
+        with open(os.path.join(packet_dir, packet_name(seq)), 'wb') as fp:
+            fp.write(data)
+        packets[seq] = data
+    return packets
+
+
+class Consumer(object):
+    # Applies packets the same way as apply_packets in mbslave-sync.py, only
+    # sleeping instead of importing them
+
+    def __init__(self, url, packets, apply_delay, linger=0):
+        self.url = url
+        self.packets = packets
+        self.apply_delay = apply_delay
+        # Seconds to wait after the last packet, before the prefetcher is
+        # closed, so that a thread that didn't stop would send more requests
+        self.linger = linger
+        self.fetched = []
+
+    def fetch(self, seq):
+        tmp = download_packet(self.url, None, seq)
+        if tmp is not None:
+            self.fetched.append(tmp)
+        return tmp
+
+    def run(self, first, depth, limit=None):
+        # Returns the sequences that were applied and the error, if any
+        if depth:
+            prefetcher = PacketPrefetcher(self.fetch, first, depth)
+            fetch = prefetcher.get
+        else:
+            prefetcher = None
+            fetch = self.fetch
+        applied = []
+        error = None
+        try:
+            seq = first
+            while limit is None or len(applied) < limit:
+                tmp = fetch(seq)
+                if tmp is None:
+                    time.sleep(self.linger)
+                    break
+                if tmp.read() != self.packets[seq]:
+                    raise AssertionError("Packet %d has wrong content" % seq)
+                time.sleep(self.apply_delay)
+                tmp.close()
+                applied.append(seq)
+                seq += 1
+        except (IOError, urllib2.URLError), e:
+            error = e
+            time.sleep(self.linger)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        return applied, error
+
+
+def check(condition, message):
+    if not condition:
+        print 'FAILED:', message
+        raise SystemExit(1)
+
+
+def wait_for_requests(server):
+    # Nothing may be requested after the prefetcher was closed
+    requests = list(server.requests)
+    time.sleep(server.delay + 0.2)
+    check(server.requests == requests, "packets %s requested after close()" % server.requests[len(requests):])
+    return requests
+
+
+parser = OptionParser(usage="%prog [options]\n\n"
+                      "Checks the packet prefetching against a local stand-in for the replication server\n"
+                      "and compares the time of applying packets with and without it.")
+parser.add_option("-n", "--packets", dest="packets", type="int", default=10, help="number of packets")
+parser.add_option("-s", "--size", dest="size", type="int", default=64, help="size of each packet in KB")
+parser.add_option("-d", "--depth", dest="depth", type="int", default=2, help="number of packets prefetched ahead")
+parser.add_option("--fetch-delay", dest="fetch_delay", type="float", default=0.05, help="seconds the server waits before answering")
+parser.add_option("--apply-delay", dest="apply_delay", type="float", default=0.05, help="seconds spent applying each packet")
+parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+options, args = parser.parse_args()
+
+first = 1000
+last = first + options.packets - 1
+packet_dir = tempfile.mkdtemp(prefix='mbslave-bench-')
+try:
+    packets = generate_packets(packet_dir, first, options.packets, options.size * 1024, options.seed)
+    server = start_server(packet_dir, options.fetch_delay)
+    url = 'http://127.0.0.1:%d/' % server.server_port
+
+    linger = options.fetch_delay * (options.depth + 2) + 0.2
+
+    # All packets are applied in order and the thread stops at the first 404
+    consumer = Consumer(url, packets, options.apply_delay, linger)
+    applied, error = consumer.run(first, options.depth)
+    check(error is None, "unexpected error %s" % error)
+    check(applied == range(first, last + 1), "applied packets %s" % applied)
+    check(wait_for_requests(server) == range(first, last + 2), "requested packets %s" % server.requests)
+
+    # Errors reach the consumer after the packets before them, and nothing
+    # is downloaded after the failed packet
+    for failure, error_class in [('error', urllib2.HTTPError), ('truncate', IOError)]:
+        failed = first + options.packets // 2
+        server.requests = []
+        server.failures = {failed: failure}
+        consumer = Consumer(url, packets, options.apply_delay, linger)
+        applied, error = consumer.run(first, options.depth)
+        check(isinstance(error, error_class), "expected %s for a packet with %s, got %r" % (error_class.__name__, failure, error))
+        check(applied == range(first, failed), "applied packets %s before a packet with %s" % (applied, failure))
+        check(wait_for_requests(server) == range(first, failed + 1), "requested packets %s with %s" % (server.requests, failure))
+    server.failures = {}
+
+    # Stopping early closes the packets that were downloaded but not applied
+    consumer = Consumer(url, packets, options.apply_delay)
+    applied, error = consumer.run(first, options.depth, limit=2)
+    check(applied == [first, first + 1], "applied packets %s before stopping" % applied)
+    check(all(tmp.closed for tmp in consumer.fetched), "prefetched packets were not closed")
+    wait_for_requests(server)
+
+    print
+    print 'All checks passed'
+    print
+    print '%-10s %8s %12s' % ('prefetch', 'time', 'packets/sec')
+    for depth in sorted(set([0, 1, options.depth])):
+        consumer = Consumer(url, packets, options.apply_delay)
+        start = time.time()
+        applied, error = consumer.run(first, depth)
+        elapsed = time.time() - start
+        print '%-10s %8.2f %12.1f' % (depth, elapsed, len(applied) / elapsed)
+    server.shutdown()
+finally:
+    shutil.rmtree(packet_dir)
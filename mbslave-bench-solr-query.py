@@ -0,0 +1,203 @@
+#!/usr/bin/env python2
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+from collections import OrderedDict
+from cStringIO import StringIO
+from mbslave import Config, connect_db
+from mbslave.search import schema, fetch_entities, KINDS
+
+
+STRATEGIES = ['merge', 'lateral']
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+
+
+class FixtureTable(object):
+    # A table with only the columns read by the search queries. Tables with
+    # a key column get one row for each id, the others are subtables with
+    # more rows for each entity.
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = OrderedDict()
+        self.key = None
+        self.links = []
+
+    def add(self, column, type, null=False):
+        if column not in self.columns:
+            self.columns[column] = (type, null)
+
+
+def fixture_tables():
+    tables = OrderedDict()
+
+    def table(name):
+        if name not in tables:
+            tables[name] = FixtureTable(name)
+        return tables[name]
+
+    def add_value(name, column):
+        table(name).add(column.name, 'uuid' if column.name == 'gid' else 'text', null=True)
+
+    for entity in schema.entities:
+        table(entity.name).add('id', 'integer')
+        table(entity.name).key = 'id'
+        for field in entity.iter_single_fields():
+            name = entity.name
+            column = field.column
+            while column.foreign is not None:
+                table(name).add(column.name, 'integer', column.foreign.null)
+                name = column.foreign.table
+                table(name).add('id', 'integer')
+                table(name).key = 'id'
+                column = column.foreign
+            add_value(name, column)
+        for field in entity.iter_multi_fields():
+            column = field.column
+            name = column.table
+            link = column.backref or entity.name
+            table(name).add(link, 'integer')
+            if link not in table(name).links:
+                table(name).links.append(link)
+            while column.foreign is not None:
+                table(name).add(column.name, 'integer', column.foreign.null)
+                name = column.foreign.table
+                key = column.foreign.backref or 'id'
+                table(name).add(key, 'integer')
+                table(name).key = key
+                column = column.foreign
+            add_value(name, column)
+    return tables.values()
+
+
+def fixture_rows(table, count, multi, rng):
+    # All integer columns reference ids between 1 and count
+    rows = count if table.key is not None else count * multi
+    for n in range(1, rows + 1):
+        row = []
+        for column, (type, null) in table.columns.iteritems():
+            if column == table.key:
+                value = str(n)
+            elif null and rng.random() < 0.1:
+                value = '\\N'
+            elif type == 'integer':
+                value = str(rng.randint(1, count))
+            elif type == 'uuid':
+                value = str(uuid.UUID(int=rng.getrandbits(128)))
+            else:
+                value = ' '.join(rng.choice(WORDS) for i in range(rng.randint(1, 4)))
+            row.append(value)
+        yield '\t'.join(row) + '\n'
+
+
+def setup_database(config, schema_name, count, multi, seed):
+    db = connect_db(config)
+    cursor = db.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema_name)
+    cursor.execute('CREATE SCHEMA %s' % schema_name)
+    cursor.execute('SET search_path = %s, public' % schema_name)
+    for table in fixture_tables():
+        columns = ', '.join('%s %s' % (column, type) for column, (type, null) in table.columns.iteritems())
+        cursor.execute('CREATE TABLE %s (%s)' % (table.name, columns))
+        rng = random.Random('%s-%s' % (seed, table.name))
+        cursor.copy_from(StringIO(''.join(fixture_rows(table, count, multi, rng))), table.name, columns=list(table.columns))
+        if table.key is not None:
+            cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (%s)' % (table.name, table.key))
+        for link in table.links:
+            cursor.execute('CREATE INDEX %s_idx_%s ON %s (%s)' % (table.name, link, table.name, link))
+    db.commit()
+    cursor.execute('ANALYZE')
+    db.commit()
+    db.close()
+
+
+def fetch_documents(config, schema_name, kinds, strategy, digest):
+    # Runs in a separate process, so that its peak memory usage can be measured
+    db = connect_db(config)
+    db.cursor().execute('SET search_path = %s, public' % schema_name)
+    docs = 0
+    fields = 0
+    md5 = hashlib.md5()
+    start = time.time()
+    for kind in kinds:
+        for id, doc in fetch_entities(db, kind, query=strategy):
+            docs += 1
+            fields += len(doc)
+            if digest:
+                # The order of values from one subtable isn't defined
+                md5.update(repr(sorted(doc)))
+    elapsed = time.time() - start
+    db.close()
+    return dict(docs=docs, fields=fields, elapsed=elapsed, digest=md5.hexdigest() if digest else None)
+
+
+def run_fetch(options, strategy, digest):
+    # Returns the results of fetch_documents and the peak RSS of the process in MB
+    args = [sys.executable, os.path.abspath(__file__), '--config', options.config, '--schema', options.schema,
+            '--kinds', options.kinds, '--run', strategy]
+    if digest:
+        args.append('--digest')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = process.stdout.read()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    if status != 0:
+        raise Exception("Fetching documents with query=%s failed" % strategy)
+    return json.loads(output), rusage.ru_maxrss / 1024.0
+
+
+parser = OptionParser(usage="%prog [options]\n\n"
+                      "Compares the strategies of reading Solr documents from the database. The fixture tables are\n"
+                      "created in a separate schema of the database configured in mbslave.conf, which is dropped first.")
+parser.add_option("-c", "--config", dest="config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mbslave.conf'), help="config file with the database to use")
+parser.add_option("-s", "--schema", dest="schema", default='mbslave_bench_solr', help="schema to create the tables in")
+parser.add_option("-k", "--kinds", dest="kinds", default=','.join(KINDS), help="entity kinds to read")
+parser.add_option("-n", "--rows", dest="rows", type="int", default=20000, help="number of rows in each table with an id")
+parser.add_option("-m", "--multi", dest="multi", type="int", default=3, help="average number of rows in subtables for each entity")
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="number of runs, the best one is reported")
+parser.add_option("--keep", dest="keep", action="store_true", default=False, help="don't create the fixture tables again")
+parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+parser.add_option("--run", dest="run", help=SUPPRESS_HELP)
+parser.add_option("--digest", dest="digest", action="store_true", default=False, help=SUPPRESS_HELP)
+options, args = parser.parse_args()
+
+config = Config(options.config)
+kinds = [kind.strip() for kind in options.kinds.split(',') if kind.strip()]
+
+if options.run:
+    print json.dumps(fetch_documents(config, options.schema, kinds, options.run, options.digest))
+    raise SystemExit(0)
+
+if not options.keep:
+    print 'Setting up schema %s with %d rows in each table' % (options.schema, options.rows)
+    setup_database(config, options.schema, options.rows, options.multi, options.seed)
+
+# Both strategies must return the same documents
+digests = {}
+for strategy in STRATEGIES:
+    result, rss = run_fetch(options, strategy, True)
+    digests[strategy] = result['digest']
+    print 'Read %d documents with %d fields using query=%s' % (result['docs'], result['fields'], strategy)
+if len(set(digests.values())) != 1:
+    print 'The strategies returned different documents'
+    raise SystemExit(1)
+
+print
+print '%-10s %8s %10s %12s %8s' % ('query', 'time', 'docs/sec', 'fields/sec', 'RSS MB')
+for strategy in STRATEGIES:
+    best = None
+    peak = 0
+    for i in range(options.repeat):
+        result, rss = run_fetch(options, strategy, False)
+        if best is None or result['elapsed'] < best['elapsed']:
+            best = result
+        peak = max(peak, rss)
+    elapsed = best['elapsed']
+    print '%-10s %8.1f %10d %12d %8.1f' % (strategy, elapsed, best['docs'] / elapsed, best['fields'] / elapsed, peak)
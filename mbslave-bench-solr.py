@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+
+import json
+import time
+import random
+import threading
+import BaseHTTPServer
+from optparse import OptionParser
+from mbslave.search import DOCUMENT_WRITERS
+from mbslave.solr import SolrClient
+
+PLAIN_CHARS = u'abcdefghijklmnopqrstuvwxyz ABCDEF0123456789\xe9\xfc\u3042'
+SPECIAL_CHARS = PLAIN_CHARS + u'&<>"\''
+
+
+def random_text(rng, special, length=20):
+    if rng.random() < special:
+        chars = SPECIAL_CHARS
+    else:
+        chars = PLAIN_CHARS
+    return u''.join(rng.choice(chars) for i in range(rng.randint(1, length)))
+
+
+def generate_docs(count, multi, special, seed):
+    # Documents shaped like artists, with a few single-valued fields and a
+    # random number of aliases, tags and IPI codes
+    rng = random.Random(seed)
+    docs = []
+    for id in range(1, count + 1):
+        fields = [
+            (u'id', u'artist:%d' % id),
+            (u'kind', u'artist'),
+            (u'mbid', u'%08x-0000-4000-8000-%012x' % (rng.getrandbits(32), rng.getrandbits(48))),
+            (u'name', random_text(rng, special)),
+            (u'sort_name', random_text(rng, special)),
+            (u'country', rng.choice([u'US', u'GB', u'DE', u'JP'])),
+        ]
+        for name in (u'alias', u'tag', u'ipi'):
+            for i in range(rng.randint(0, multi * 2)):
+                fields.append((name, random_text(rng, special)))
+        docs.append(fields)
+    return docs
+
+
+class UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Accepts anything posted to /update and answers like Solr with wt=json
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received += len(body)
+        if self.path.split('?')[0].endswith('/update'):
+            status, response = 200, json.dumps({'responseHeader': {'status': 0, 'QTime': 0}})
+        else:
+            status, response = 404, 'Not Found'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), UpdateHandler)
+    server.received = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def measure(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def serialize(writer, docs):
+    return [writer.add(fields) for fields in docs]
+
+
+def post(client, commands, batch_docs):
+    for i in range(0, len(commands), batch_docs):
+        client.update(commands[i:i + batch_docs])
+    client.commit()
+
+
+parser = OptionParser(usage="%prog [options]")
+parser.add_option("-n", "--docs", dest="docs", type="int", default=50000, help="number of synthetic documents")
+parser.add_option("-m", "--multi", dest="multi", type="int", default=3, help="average number of values of each multi-valued field")
+parser.add_option("-s", "--special", dest="special", type="float", default=0.1, help="fraction of values with characters that need escaping")
+parser.add_option("-b", "--batch-docs", dest="batch_docs", type="int", default=1000, help="number of documents posted in one request")
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="number of runs, the best one is reported")
+parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+options, args = parser.parse_args()
+
+docs = generate_docs(options.docs, options.multi, options.special, options.seed)
+server = start_server()
+url = 'http://127.0.0.1:%d/solr/musicbrainz' % server.server_port
+
+print '%-8s %14s %14s %14s' % ('format', 'serialize/sec', 'post/sec', 'MB')
+for name in sorted(DOCUMENT_WRITERS):
+    writer = DOCUMENT_WRITERS[name]()
+    elapsed, commands = measure(lambda: serialize(writer, docs), options.repeat)
+    if name == 'json':
+        # Every document must survive the round trip with all of its values
+        for fields, command in zip(docs, commands):
+            doc = json.loads('{%s}' % command)['add']['doc']
+            values = sum(len(value) if isinstance(value, list) else 1 for value in doc.values())
+            if values != len(fields):
+                print 'Document %s does not match the generated fields' % fields[0][1]
+                raise SystemExit(1)
+    client = SolrClient(url, writer)
+    server.received = 0
+    post_elapsed, result = measure(lambda: post(client, commands, options.batch_docs), options.repeat)
+    client.close()
+    size = server.received / options.repeat
+    print '%-8s %14d %14d %14.1f' % (name, len(docs) / elapsed, len(docs) / post_elapsed, size / 1024.0 / 1024.0)
+
+server.shutdown()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python2
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import uuid
+import random
+import shutil
+import tarfile
+import tempfile
+import subprocess
+import ConfigParser
+from optparse import OptionParser
+from cStringIO import StringIO
+from mbslave import Config, connect_db
+from mbslave.dbmirror import escape, format_data_fields, format_copy_data
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PHASES = ['download', 'decompress', 'parse', 'coalesce', 'apply', 'hooks', 'commit']
+
+
+class Column(object):
+
+    def __init__(self, name, type, size, nullable):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.nullable = nullable
+
+
+def load_table_definitions(names):
+    # Returns {table: (CREATE TABLE statement, [Column])} for the tables in
+    # sql/CreateTables.sql
+    sql = open(os.path.join(BASE_DIR, 'sql', 'CreateTables.sql')).read()
+    tables = {}
+    for match in re.finditer(r'^CREATE TABLE (\w+) \(.*?^\);', sql, re.M | re.S):
+        name = match.group(1)
+        if name not in names:
+            continue
+        columns = []
+        for line in match.group(0).splitlines()[1:]:
+            column = re.match(r'    ([a-z_0-9]+)\s+([A-Z]+(?: WITH(?:OUT)? TIME ZONE)?)(?:\((\d+)\))?(.*)', line)
+            if column is None:
+                continue
+            column_name, type, size, rest = column.groups()
+            nullable = 'NOT NULL' not in rest and 'PRIMARY KEY' not in rest
+            columns.append(Column(column_name, type, int(size) if size else None, nullable))
+        tables[name] = match.group(0), columns
+    for name in names:
+        if name not in tables:
+            raise Exception("Table %s not found in sql/CreateTables.sql" % name)
+        if tables[name][1][0].name != 'id':
+            raise Exception("Table %s doesn't have an id column" % name)
+    return tables
+
+
+class RowGenerator(object):
+    # Random values for the columns of a table, nullable columns are always
+    # NULL so that no CHECK constraint can be violated
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def value(self, column):
+        rng = self.rng
+        if column.nullable:
+            return None
+        if column.type in ('SERIAL', 'INTEGER', 'BIGINT'):
+            return str(rng.randint(1, 100000))
+        if column.type == 'SMALLINT':
+            return str(rng.randint(0, 2))
+        if column.type in ('VARCHAR', 'TEXT', 'CHAR', 'CHARACTER'):
+            length = rng.randint(1, 30)
+            if column.size:
+                length = min(length, column.size) if column.type == 'VARCHAR' else column.size
+            return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz \'\\') for i in range(length))
+        if column.type == 'UUID':
+            return str(uuid.UUID(int=rng.getrandbits(128)))
+        if column.type == 'BOOLEAN':
+            return rng.choice('tf')
+        if column.type.startswith('TIMESTAMP'):
+            return '2019-05-13 12:00:00+00'
+        raise Exception("Column %s has an unsupported type %s" % (column.name, column.type))
+
+    def row(self, id, columns):
+        return [str(id)] + [self.value(column) for column in columns[1:]]
+
+
+class PacketGenerator(object):
+
+    def __init__(self, tables, initial_rows, mix, seed):
+        self.tables = tables
+        self.rng = random.Random(seed)
+        self.rows = RowGenerator(self.rng)
+        self.mix = mix
+        self.live = {}
+        self.next_id = {}
+        for name in tables:
+            self.live[name] = range(1, initial_rows + 1)
+            self.next_id[name] = initial_rows + 1
+
+    def choose_type(self):
+        i, u, d = self.mix
+        x = self.rng.random() * (i + u + d)
+        if x < i:
+            return 'i'
+        if x < i + u:
+            return 'u'
+        return 'd'
+
+    def changes(self, count):
+        # Yields (table, type, keys, values) tuples, as field lists
+        names = sorted(self.tables)
+        for n in range(count):
+            name = self.rng.choice(names)
+            columns = self.tables[name][1]
+            live = self.live[name]
+            type = self.choose_type()
+            if type != 'i' and not live:
+                type = 'i'
+            if type == 'i':
+                id = self.next_id[name]
+                self.next_id[name] += 1
+                live.append(id)
+                row = self.rows.row(id, columns)
+                yield name, type, None, zip([column.name for column in columns], row)
+                continue
+            i = self.rng.randrange(len(live))
+            id = live[i]
+            keys = [('id', str(id))]
+            if type == 'u':
+                row = self.rows.row(id, columns)
+                yield name, type, keys, zip([column.name for column in columns], row)
+            else:
+                live[i] = live[-1]
+                live.pop()
+                yield name, type, keys, None
+
+    def packet(self, path, schema_seq, replication_seq, rows):
+        pending = []
+        pending_data = []
+        id = 0
+        xid = replication_seq * 1000000
+        changes = list(self.changes(rows))
+        changes.append(('replication_control', 'u', [('id', '1')], [
+            ('id', '1'), ('current_schema_sequence', str(schema_seq)),
+            ('current_replication_sequence', str(replication_seq)),
+            ('last_replication_date', '2019-05-13 12:00:00+00')]))
+        for n, (name, type, keys, values) in enumerate(changes):
+            # Transactions of 5 changes on average, replication_control in its own
+            if n == len(changes) - 1 or self.rng.random() < 0.2:
+                xid += 1
+            id += 1
+            pending.append('%d\t"musicbrainz"."%s"\t%s\t%d\n' % (id, name, type, xid))
+            if keys is not None:
+                pending_data.append('%d\tt\t%s\n' % (id, escape(format_data_fields(keys))))
+            if values is not None:
+                pending_data.append('%d\tf\t%s\n' % (id, escape(format_data_fields(values))))
+        tar = tarfile.open(path, 'w:bz2')
+        for name, data in [('SCHEMA_SEQUENCE', '%d\n' % schema_seq),
+                           ('TIMESTAMP', '2019-05-13 12:00:00.000000+00\n'),
+                           ('mbdump/Pending', ''.join(pending)),
+                           ('mbdump/PendingData', ''.join(pending_data))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        return len(changes)
+
+
+def initial_rows(columns, count, seed):
+    rows = RowGenerator(random.Random(seed))
+    return [rows.row(id, columns) for id in range(1, count + 1)]
+
+
+def setup_database(config, schema, tables, initial, schema_seq, seed):
+    db = connect_db(config)
+    cursor = db.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+    cursor.execute('CREATE SCHEMA %s' % schema)
+    cursor.execute('SET search_path = %s, public' % schema)
+    for name in sorted(tables):
+        sql, columns = tables[name]
+        cursor.execute(sql)
+        cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id)' % name)
+        if name != 'replication_control':
+            data = format_copy_data(initial_rows(columns, initial, '%s-%s' % (seed, name)))
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (name, ', '.join(column.name for column in columns)), StringIO(data))
+    cursor.execute('INSERT INTO replication_control (id, current_schema_sequence, current_replication_sequence) VALUES (1, %s, 0)', (schema_seq,))
+    db.commit()
+    cursor.execute('ANALYZE')
+    db.commit()
+    db.close()
+
+
+def write_config(path, base_path, schema, report_dir, overrides):
+    parser = ConfigParser.RawConfigParser()
+    parser.read(base_path)
+    values = [('schemas', 'musicbrainz', schema), ('monitoring', 'enabled', 'no'), ('monitoring', 'report_dir', report_dir)]
+    values += overrides
+    for section, key, value in values:
+        if not parser.has_section(section):
+            parser.add_section(section)
+        parser.set(section, key, value)
+    with open(path, 'w') as fp:
+        parser.write(fp)
+
+
+def parse_strategy(strategy):
+    # "batch=yes,bzip2.workers=4" sets batch in [sync] and workers in [bzip2]
+    overrides = []
+    for item in strategy.split(','):
+        if not item.strip():
+            continue
+        key, value = item.split('=', 1)
+        if '.' in key:
+            section, key = key.split('.', 1)
+        else:
+            section = 'sync'
+        overrides.append((section, key.strip(), value.strip()))
+    return overrides
+
+
+def run_sync(config_path, packet_dir, log_path):
+    # Returns the wall time and the peak RSS of the sync process in MB
+    start = time.time()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'mbslave-sync.py'),
+                                    '--config', config_path, '--packet-dir', packet_dir], stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise Exception("mbslave-sync.py failed, see %s" % log_path)
+    return elapsed, rusage.ru_maxrss / 1024.0
+
+
+def read_reports(report_dir):
+    phases = dict((name, 0.0) for name in PHASES)
+    rows = 0
+    for path in glob.glob(os.path.join(report_dir, 'replication-*.json')):
+        report = json.load(open(path))
+        rows += report['rows']
+        for name, entry in report['phases'].iteritems():
+            phases[name] = phases.get(name, 0.0) + entry['wall']
+    return rows, phases
+
+
+parser = OptionParser(usage="%prog [options] [STRATEGY]...\n\n"
+                      "Each STRATEGY is a list of config options like batch=yes,coalesce=yes or bzip2.workers=4,\n"
+                      "the packets are applied once for each of them. The tables are created in a separate schema\n"
+                      "of the database configured in mbslave.conf, which is dropped first.")
+parser.add_option("-c", "--config", dest="config", default=os.path.join(BASE_DIR, 'mbslave.conf'), help="config file with the database to use")
+parser.add_option("-s", "--schema", dest="schema", default='mbslave_bench', help="schema to create the tables in")
+parser.add_option("-t", "--tables", dest="tables", default='artist,release_group,release,medium,track,recording', help="tables to change")
+parser.add_option("-n", "--packets", dest="packets", type="int", default=10, help="number of packets")
+parser.add_option("-r", "--rows", dest="rows", type="int", default=10000, help="number of changes in each packet")
+parser.add_option("-i", "--initial", dest="initial", type="int", default=100000, help="number of rows in each table before the first packet")
+parser.add_option("-m", "--mix", dest="mix", default='2:2:1', help="ratio of inserts, updates and deletes")
+parser.add_option("-d", "--packet-dir", dest="packet_dir", help="keep the generated packets in this directory")
+parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+options, args = parser.parse_args()
+
+strategies = args or ['']
+mix = [float(i) for i in options.mix.split(':')]
+config = Config(options.config)
+schema_seq = 25
+
+names = [name.strip() for name in options.tables.split(',') if name.strip()]
+tables = load_table_definitions(names + ['replication_control'])
+generator = PacketGenerator(dict((name, tables[name]) for name in names), options.initial, mix, options.seed)
+
+tmp_dir = tempfile.mkdtemp(prefix='mbslave-bench-')
+try:
+    packet_dir = options.packet_dir or os.path.join(tmp_dir, 'packets')
+    if not os.path.isdir(packet_dir):
+        os.makedirs(packet_dir)
+    print 'Generating %d packets with %d changes each in %s' % (options.packets, options.rows, packet_dir)
+    for seq in range(1, options.packets + 1):
+        generator.packet(os.path.join(packet_dir, 'replication-%d.tar.bz2' % seq), schema_seq, seq, options.rows)
+
+    results = []
+    for n, strategy in enumerate(strategies):
+        name = strategy or 'default'
+        report_dir = os.path.join(tmp_dir, 'reports-%d' % n)
+        os.makedirs(report_dir)
+        config_path = os.path.join(tmp_dir, 'mbslave-%d.conf' % n)
+        log_path = os.path.join(tmp_dir, 'sync-%d.log' % n)
+        write_config(config_path, options.config, options.schema, report_dir, parse_strategy(strategy))
+        print 'Setting up schema %s for %s' % (options.schema, name)
+        setup_database(config, options.schema, tables, options.initial, schema_seq, options.seed)
+        print 'Applying packets with %s' % (name,)
+        try:
+            elapsed, rss = run_sync(config_path, packet_dir, log_path)
+        except Exception:
+            print open(log_path).read()
+            raise
+        rows, phases = read_reports(report_dir)
+        results.append((name, elapsed, rows, rss, phases))
+
+    print
+    print '%-30s %8s %10s %8s %s' % ('strategy', 'time', 'rows/sec', 'RSS MB', ' '.join('%10s' % phase for phase in PHASES))
+    for name, elapsed, rows, rss, phases in results:
+        print '%-30s %8.1f %10d %8.1f %s' % (name, elapsed, rows / elapsed, rss, ' '.join('%10.2f' % phases[phase] for phase in PHASES))
+finally:
+    shutil.rmtree(tmp_dir)
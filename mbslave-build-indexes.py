@@ -0,0 +1,210 @@
+#!/usr/bin/env python2
+
+import os
+import re
+import sys
+import time
+import threading
+import psycopg2
+from optparse import OptionParser
+from mbslave import Config, connect_db, check_table_exists
+from mbslave.schema import read_schema_files, qualify_name, remap_schema, split_statements
+
+
+PHASES = [
+    ('primary keys', ['CreatePrimaryKeys.sql']),
+    ('indexes', ['CreateIndexes.sql', 'CreateSlaveIndexes.sql']),
+    ('foreign keys', ['CreateFKConstraints.sql']),
+]
+
+INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(\w+)\s+ON\s+([\w.]+)', re.I)
+CONSTRAINT_RE = re.compile(r'ALTER\s+TABLE\s+([\w.]+)\s+ADD\s+CONSTRAINT\s+(\w+)\s+(?:FOREIGN\s+KEY\s*\([^)]*\)\s+REFERENCES\s+([\w.]+))?', re.I)
+
+
+class BuildStatement(object):
+
+    def __init__(self, schema, sql, table=None, name=None, references=None):
+        self.schema = schema
+        self.sql = sql
+        self.table = table
+        self.name = name
+        self.references = references
+        self.size = 0
+        self.locks = set()
+
+    def describe(self):
+        if self.table is None:
+            return ' '.join(self.sql.split()[:4])
+        return '%s on %s (%d MB)' % (self.name, self.table, self.size / 1024 / 1024)
+
+
+def parse_statement(config, default_schema, sql):
+    schema = config.schema.name(default_schema)
+    match = INDEX_RE.match(sql)
+    if match is not None:
+        return BuildStatement(schema, sql, qualify_name(config, default_schema, match.group(2)), match.group(1))
+    match = CONSTRAINT_RE.match(sql)
+    if match is not None:
+        statement = BuildStatement(schema, sql, qualify_name(config, default_schema, match.group(1)), match.group(2))
+        # ALTER TABLE locks the table against other changes to it, and foreign
+        # keys also the referenced table, so they are not built at the same time
+        statement.locks.add(statement.table)
+        if match.group(3):
+            statement.references = qualify_name(config, default_schema, match.group(3))
+            statement.locks.add(statement.references)
+        return statement
+    return BuildStatement(schema, sql)
+
+
+def load_statements(config, patterns):
+    statements = []
+    for pattern in patterns:
+        for default_schema, sql in read_schema_files(pattern):
+            sql = remap_schema(config, sql)
+            for statement in split_statements(sql):
+                if statement.upper() in ('BEGIN', 'COMMIT') or statement.upper().startswith('SET SEARCH_PATH'):
+                    continue
+                statements.append(parse_statement(config, default_schema, statement))
+    return statements
+
+
+def statement_exists(cursor, statement):
+    schema, table = statement.table.split('.', 1)
+    if statement.locks:
+        cursor.execute("""
+            SELECT 1 FROM pg_constraint c
+            JOIN pg_class t ON t.oid = c.conrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            WHERE n.nspname = %s AND t.relname = %s AND c.conname = %s
+        """, (schema, table, statement.name))
+    else:
+        cursor.execute("""
+            SELECT 1 FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s
+        """, (schema, statement.name))
+    return cursor.fetchone() is not None
+
+
+def plan_statements(db, statements):
+    # Leaves out statements for tables that don't exist and indexes or
+    # constraints that were already built, the rest is sorted by table size
+    cursor = db.cursor()
+    planned = []
+    for statement in statements:
+        if statement.table is not None:
+            missing = [table for table in (statement.table, statement.references) if table and not check_table_exists(db, *table.split('.', 1))]
+            if missing:
+                print " - Skipping %s (table %s does not exist)" % (statement.name, missing[0])
+                continue
+            if statement_exists(cursor, statement):
+                print " - Skipping %s (already exists)" % (statement.name,)
+                continue
+            cursor.execute("SELECT pg_relation_size(%s::regclass)", (statement.table,))
+            statement.size = cursor.fetchone()[0]
+        planned.append(statement)
+    db.rollback()
+    planned.sort(key=lambda statement: -statement.size)
+    return planned
+
+
+class StatementRunner(object):
+    # Runs statements on a pool of connections, largest tables first. A
+    # statement is not started while another one locks the same tables.
+
+    def __init__(self, config, statements, workers, maintenance_work_mem=None):
+        self.config = config
+        self.pending = list(statements)
+        self.total = len(statements)
+        self.done = 0
+        self.busy = set()
+        self.errors = []
+        self.maintenance_work_mem = maintenance_work_mem
+        self.cond = threading.Condition()
+        self.threads = [threading.Thread(target=self.run) for i in range(min(workers, len(statements)))]
+
+    def next_statement(self):
+        with self.cond:
+            while self.pending:
+                for i, statement in enumerate(self.pending):
+                    if not (statement.locks & self.busy):
+                        self.busy.update(statement.locks)
+                        return self.pending.pop(i)
+                self.cond.wait(1)
+
+    def finish_statement(self, statement, started, error=None):
+        with self.cond:
+            self.busy.difference_update(statement.locks)
+            self.done += 1
+            if error is not None:
+                self.errors.append(error)
+                print " - [%d/%d] Failed to build %s: %s" % (self.done, self.total, statement.describe(), str(error).strip())
+            else:
+                print " - [%d/%d] Built %s in %.1fs" % (self.done, self.total, statement.describe(), time.time() - started)
+            self.cond.notify_all()
+
+    def run(self):
+        try:
+            db = connect_db(self.config)
+        except psycopg2.Error, e:
+            with self.cond:
+                self.errors.append(e)
+            return
+        db.autocommit = True
+        try:
+            cursor = db.cursor()
+            if self.maintenance_work_mem:
+                cursor.execute("SET maintenance_work_mem = %s", (self.maintenance_work_mem,))
+            while True:
+                statement = self.next_statement()
+                if statement is None:
+                    break
+                started = time.time()
+                try:
+                    cursor.execute("SET search_path TO %s, public", (statement.schema,))
+                    cursor.execute(statement.sql)
+                except psycopg2.Error, e:
+                    self.finish_statement(statement, started, e)
+                    continue
+                self.finish_statement(statement, started)
+        finally:
+            db.close()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+        return not self.errors and not self.pending
+
+
+parser = OptionParser()
+parser.add_option("-c", "--config", dest="config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mbslave.conf'), help="path to the config file")
+parser.add_option("-j", "--workers", dest="workers", type="int", default=4, help="number of connections building indexes")
+parser.add_option("-m", "--maintenance-work-mem", dest="maintenance_work_mem", help="maintenance_work_mem of each connection, e.g. 1GB")
+parser.add_option("--foreign-keys", dest="foreign_keys", action="store_true", default=False, help="also create foreign key constraints")
+parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False, help="only print the statements in the order they would be started")
+options, args = parser.parse_args()
+
+config = Config(options.config)
+db = connect_db(config)
+
+for phase, patterns in PHASES:
+    if phase == 'foreign keys' and not options.foreign_keys:
+        continue
+    print "Building %s" % (phase,)
+    statements = plan_statements(db, load_statements(config, patterns))
+    if options.dry_run:
+        for statement in statements:
+            print " - %s" % (statement.describe(),)
+        continue
+    started = time.time()
+    runner = StatementRunner(config, statements, options.workers, options.maintenance_work_mem)
+    runner.start()
+    if not runner.join():
+        print "Failed to build %d of %d %s, stopping" % (len(runner.errors) + len(runner.pending), len(statements), phase)
+        sys.exit(1)
+    print "Built %d %s in %.1fs" % (len(statements), phase, time.time() - started)
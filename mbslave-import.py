@@ -1,14 +1,24 @@
 #!/usr/bin/env python2
 
-import tarfile
 import sys
 import os
+import heapq
+import shutil
+import tempfile
+import threading
+import psycopg2
+from contextlib import closing
+from optparse import OptionParser
 from mbslave import Config, connect_db, parse_name, check_table_exists, fqn
+from mbslave.bzip2 import BZ2TarFile
+from mbslave.diff import diff_table
+from mbslave.download import HTTPStream
+from mbslave.schema import load_tables, load_table_columns
 
 
-def load_tar(filename, db, config, ignored_schemas, ignored_tables):
-    print "Importing data from", filename
-    tar = tarfile.open(filename, 'r:bz2')
+def iter_members(tar, db, config, ignored_schemas, ignored_tables, diff=False):
+    # Yields the members that should be loaded, with their target tables and
+    # whether they are empty, tables with data are only included for diff
     cursor = db.cursor()
     for member in tar:
         if not member.name.startswith('mbdump/'):
@@ -26,18 +36,206 @@ def load_tar(filename, db, config, ignored_schemas, ignored_tables):
             print " - Skipping %s (table %s does not exist)" % (name, fulltable)
             continue
         cursor.execute("SELECT 1 FROM %s LIMIT 1" % fulltable)
-        if cursor.fetchone():
+        empty = cursor.fetchone() is None
+        if not empty and not diff:
             print " - Skipping %s (table %s already contains data)" % (name, fulltable)
             continue
-        print " - Loading %s to %s" % (name, fulltable)
-        cursor.copy_from(tar.extractfile(member), fulltable)
-        db.commit()
+        yield member, name, fulltable, empty
+
+
+def copy_table(db, fileobj, fulltable, freeze=False):
+    cursor = db.cursor()
+    if freeze:
+        # Loading into a table truncated in the same transaction skips WAL with
+        # wal_level=minimal and the rows don't need to be frozen or have hint
+        # bits set by the first reads
+        cursor.execute("TRUNCATE %s" % fulltable)
+        cursor.copy_expert("COPY %s FROM STDIN WITH (FREEZE)" % fulltable, fileobj)
+    else:
+        cursor.copy_from(fileobj, fulltable)
+    db.commit()
+
+
+def check_freeze_tables(db, config, ignored_schemas, ignored_tables):
+    # Tables are truncated before loading them with COPY FREEZE, so this only
+    # runs on a schema with no data and no indexes yet
+    cursor = db.cursor()
+    for fulltable in sorted(load_tables(config)):
+        schema, table = fulltable.split('.', 1)
+        if schema in ignored_schemas or table in ignored_tables:
+            continue
+        if not check_table_exists(db, schema, table):
+            continue
+        cursor.execute("SELECT 1 FROM %s LIMIT 1" % fulltable)
+        if cursor.fetchone():
+            sys.exit("Table %s already contains data, freeze=yes can only be used for a new database" % fulltable)
+        cursor.execute("SELECT count(*) FROM pg_index WHERE indrelid = %s::regclass", (fulltable,))
+        if cursor.fetchone()[0]:
+            sys.exit("Table %s has indexes, create them after the import when using freeze=yes" % fulltable)
+    cursor.execute("SHOW wal_level")
+    wal_level = cursor.fetchone()[0]
+    if wal_level != 'minimal':
+        print "The server uses wal_level=%s, the data will still be written to WAL" % wal_level
+    db.commit()
+
+
+def open_dump(filename):
+    # Dumps given by URL are decompressed and loaded while downloading
+    if filename.startswith(('http://', 'https://')):
+        return HTTPStream(filename)
+    return open(filename, 'rb')
+
+
+def load_tar(filename, db, config, ignored_schemas, ignored_tables, loader=None, diff=False):
+    print "Importing data from", filename
+    if diff:
+        table_columns = load_table_columns(config)
+    with closing(open_dump(filename)) as fileobj, BZ2TarFile(fileobj, config) as tar:
+        for member, name, fulltable, empty in iter_members(tar, db, config, ignored_schemas, ignored_tables, diff):
+            if not empty:
+                print " - Comparing %s with %s" % (name, fulltable)
+                try:
+                    changed, total, deleted, updated, inserted = diff_table(db, tar.extractfile(member), fulltable, table_columns.get(fulltable), config.import_.diff_chunk_size)
+                except ValueError, e:
+                    db.rollback()
+                    print " - Skipping %s (%s)" % (name, e)
+                    continue
+                except psycopg2.IntegrityError, e:
+                    # E.g. rows of other tables still reference the deleted
+                    # chunks, the table is left unchanged
+                    db.rollback()
+                    print " - Skipping %s, replacing the changed rows violates a constraint (%s)" % (name, str(e).strip().splitlines()[0])
+                    continue
+                print " - Compared %d of %d chunks in %s by rows, deleted %d, updated %d and inserted %d rows" % (changed, total, fulltable, deleted, updated, inserted)
+                continue
+            if loader is not None:
+                db.commit()
+                loader.load(name, fulltable, tar.extractfile(member), member.size)
+                continue
+            print " - Loading %s to %s" % (name, fulltable)
+            copy_table(db, tar.extractfile(member), fulltable, config.import_.freeze)
+
+
+class ParallelLoader(object):
+    # Loads tables using a pool of connections. The archive is read by the
+    # main thread, which copies each member to a temporary file and the
+    # workers load the largest waiting one first. When the temporary files
+    # would take more than spool_size bytes, the main thread waits for the
+    # workers, and members larger than that are loaded directly from the
+    # archive on the main connection.
+
+    def __init__(self, db, config):
+        self.db = db
+        self.config = config
+        self.spool_dir = config.import_.spool_dir
+        self.spool_size = config.import_.spool_size * 1024 * 1024
+        self.spooled = 0
+        self.pending = []
+        self.counter = 0
+        self.closed = False
+        self.errors = []
+        self.cond = threading.Condition()
+        self.threads = []
+        for i in range(config.import_.workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def check_errors(self):
+        if self.errors:
+            exc_info = self.errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def load(self, name, fulltable, fileobj, size):
+        with self.cond:
+            direct = self.spool_size and size > self.spool_size
+            while not direct and not self.errors and self.spool_size and self.spooled + size > self.spool_size:
+                self.cond.wait(1)
+            self.check_errors()
+            if not direct:
+                self.spooled += size
+        if direct:
+            print " - Loading %s to %s" % (name, fulltable)
+            copy_table(self.db, fileobj, fulltable, self.config.import_.freeze)
+            return
+        print " - Spooling %s (%d MB)" % (name, size / 1024 / 1024)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.spool_dir, prefix='mbslave-import-', delete=False) as tmp:
+                shutil.copyfileobj(fileobj, tmp, 1024 * 1024)
+        except:
+            with self.cond:
+                self.spooled -= size
+            raise
+        with self.cond:
+            self.counter += 1
+            heapq.heappush(self.pending, (-size, self.counter, name, fulltable, tmp.name))
+            self.cond.notify()
+
+    def run(self):
+        try:
+            db = connect_db(self.config)
+        except Exception:
+            with self.cond:
+                self.errors.append(sys.exc_info())
+                self.cond.notify_all()
+            return
+        try:
+            while True:
+                with self.cond:
+                    while not self.pending and not self.closed and not self.errors:
+                        self.cond.wait(1)
+                    if self.errors or not self.pending:
+                        break
+                    size, counter, name, fulltable, path = heapq.heappop(self.pending)
+                    size = -size
+                try:
+                    print " - Loading %s to %s" % (name, fulltable)
+                    with open(path, 'rb') as fileobj:
+                        copy_table(db, fileobj, fulltable, self.config.import_.freeze)
+                except Exception:
+                    with self.cond:
+                        self.errors.append(sys.exc_info())
+                finally:
+                    os.remove(path)
+                    with self.cond:
+                        self.spooled -= size
+                        self.cond.notify_all()
+        finally:
+            db.close()
+
+    def close(self):
+        # Waits until all spooled tables are loaded
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+        for size, counter, name, fulltable, path in self.pending:
+            os.remove(path)
+        self.pending = []
+        self.check_errors()
+
 
+parser = OptionParser(usage="%prog [options] DUMP...")
+parser.add_option("--diff", dest="diff", action="store_true", default=False, help="update tables that already contain data by replacing the parts that differ from the dump")
+options, args = parser.parse_args()
 
 config = Config(os.path.dirname(__file__) + '/mbslave.conf')
 db = connect_db(config)
 
 ignored_schemas = set(config.get('schemas', 'ignore').split(','))
 ignored_tables = set(config.get('TABLES', 'ignore').split(','))
-for filename in sys.argv[1:]:
-    load_tar(filename, db, config, ignored_schemas, ignored_tables)
+if config.import_.freeze:
+    check_freeze_tables(db, config, ignored_schemas, ignored_tables)
+if config.import_.workers > 1:
+    loader = ParallelLoader(db, config)
+else:
+    loader = None
+try:
+    for filename in args:
+        load_tar(filename, db, config, ignored_schemas, ignored_tables, loader, options.diff)
+finally:
+    if loader is not None:
+        loader.close()
@@ -1,15 +1,25 @@
 #!/usr/bin/env python2
 
 import os
-from lxml import etree as ET
+import sys
+from optparse import OptionParser
 from mbslave import Config, connect_db
-from mbslave.search import fetch_all
+from mbslave.search import fetch_all, export_parallel, document_writer, write_export
 
-cfg = Config(os.path.join(os.path.dirname(__file__), 'mbslave.conf'))
-db = connect_db(cfg, True)
+parser = OptionParser()
+parser.add_option("-j", "--workers", dest="workers", type="int", default=1, help="number of processes exporting ranges of ids in parallel")
+parser.add_option("-r", "--range-size", dest="range_size", type="int", default=100000, help="number of ids in each range exported by one process")
+parser.add_option("-o", "--output-dir", dest="output_dir", help="write each range to a separate file in this directory instead of the standard output")
+options, args = parser.parse_args()
 
-print '<add>'
-for id, doc in fetch_all(cfg, db):
-    print ET.tostring(doc)
-print '</add>'
+cfg = Config(os.path.join(os.path.dirname(__file__), 'mbslave.conf'))
+writer = document_writer(cfg)
 
+if options.output_dir:
+    for path in export_parallel(cfg, options.workers, options.range_size, options.output_dir, writer):
+        print >>sys.stderr, "Exported", path
+elif options.workers > 1:
+    write_export(sys.stdout, writer, export_parallel(cfg, options.workers, options.range_size, writer=writer))
+else:
+    db = connect_db(cfg, True)
+    write_export(sys.stdout, writer, (writer.doc(fields) for id, fields in fetch_all(cfg, db)))
@@ -1,32 +1,36 @@
 #!/usr/bin/env python2
 
 import os
-import urllib2
-from cStringIO import StringIO
-from lxml import etree as ET
 from mbslave import Config, connect_db
-from mbslave.search import fetch_all_updated
+from mbslave.search import fetch_updated_chunks, document_writer
+from mbslave.solr import SolrClient, SolrError
 
 cfg = Config(os.path.join(os.path.dirname(__file__), 'mbslave.conf'))
 db = connect_db(cfg, True)
 
-xml = StringIO()
-xml.write('<update>\n')
-for doc in fetch_all_updated(cfg, db):
-    xml.write(ET.tostring(doc))
-    xml.write('\n')
-xml.write('</update>\n')
-
-req = urllib2.Request(cfg.solr.url + '/update?commit=true', xml.getvalue(),
-    {'Content-Type': 'application/xml; encoding=UTF-8'})
-resp = urllib2.urlopen(req)
-the_page = resp.read()
-
-doc = ET.fromstring(the_page)
-status = doc.find("lst[@name='responseHeader']/int[@name='status']")
-if status.text != '0':
-    print the_page
+writer = document_writer(cfg)
+solr = SolrClient(cfg.solr.url, writer)
+updated = False
+try:
+    for commands in fetch_updated_chunks(cfg, db, cfg.solr.queue_chunk_size, writer):
+        batch = []
+        batch_size = 0
+        for command in commands:
+            batch.append(command)
+            batch_size += len(command)
+            if len(batch) >= cfg.solr.batch_docs or batch_size >= cfg.solr.batch_size * 1024 * 1024:
+                solr.update(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            solr.update(batch)
+        # The chunk is only removed from the queue after Solr accepted it
+        db.commit()
+        updated = True
+    if updated:
+        solr.commit()
+except SolrError, e:
+    print e
     raise SystemExit(1)
-
-db.commit()
-
+finally:
+    solr.close()
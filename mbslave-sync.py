@@ -1,168 +1,1013 @@
 #!/usr/bin/env python2
 
-import tarfile
 import os
 import re
-import urllib2
-import shutil
+import sys
+import time
+import calendar
 import tempfile
+import marshal
+import struct
+import bisect
+import threading
+import cProfile
+import socket
+import httplib
+import urllib2
+import psycopg2
+from array import array
+from cStringIO import StringIO
+from collections import OrderedDict
+from optparse import OptionParser
 from mbslave import Config, ReplicationHook, connect_db, parse_name, fqn
-from mbslave.monitoring import StatusReport
+from mbslave.bzip2 import BZ2TarFile
+from mbslave.dbmirror import read_psql_dump, parse_data_fields, parse_bool, format_copy_data
+from mbslave.monitoring import StatusReport, PacketTimer
+from mbslave.indexes import defer_indexes, rebuild_deferred_indexes
+from mbslave.schema import read_schema_files, qualify_name
+from mbslave.packets import PacketCache, PacketPrefetcher, IncompleteDownload, download_packet, open_local_packet
+
+
+def load_foreign_keys(config):
+    # Returns a set of (table, referenced table) pairs, using the FK
+    # constraints of the MusicBrainz schema
+    foreign_keys = set()
+    for default_schema, sql in read_schema_files('Create*FKConstraints.sql'):
+        for names in re.findall(r'ALTER TABLE\s+([\w.]+)\s+ADD CONSTRAINT\s+\w+\s+FOREIGN KEY\s*\([^)]*\)\s+REFERENCES\s+([\w.]+)', sql):
+            foreign_keys.add(tuple(qualify_name(config, default_schema, name) for name in names))
+    return foreign_keys
+
+
+class ChangeChain(object):
+    # Net effect of consecutive changes to one row, kept at the position of
+    # the first change
+
+    def __init__(self, pos, type, keys, values):
+        self.pos = pos
+        self.type = type
+        self.keys = keys
+        self.values = values
+        self.merged = 0
+
+
+class PendingDataStore(object):
+    # Parsed PendingData rows, keyed by (id, key). Once the estimated size of
+    # the rows held in memory exceeds the limit, all rows are moved to a
+    # temporary file and only a sorted index of their offsets is kept.
 
+    RECORD_HEADER = struct.Struct('<qI')
 
-def parse_data_fields(s):
-    fields = {}
-    for name, value in re.findall(r'''"([^"]+)"=('(?:''|[^'])*')? ''', s):
-        if not value:
-            value = None
+    def __init__(self, memory_limit=0):
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self._data = {}
+        self._file = None
+        self._codes = array('l')
+        self._offsets = array('l')
+        self._sorted = True
+        self._lock = threading.Lock()
+
+    def add(self, id, key, values):
+        if self._file is None:
+            self._data[(id, key)] = values
+            self.memory_used += 200 + sum(64 + len(k) + len(v or '') for k, v in values.iteritems())
+            if self.memory_limit and self.memory_used > self.memory_limit:
+                self.spill()
         else:
-            value = value[1:-1].replace("''", "'").replace("\\\\", "\\")
-        fields[name] = value
-    return fields
+            self._write(id * 2 + int(key), values)
+
+    def spill(self):
+        print ' - Moving pending data to disk (%d MB in memory)' % (self.memory_used / 1024 / 1024)
+        self._file = tempfile.TemporaryFile(prefix='mbslave-pending-')
+        data = self._data
+        self._data = {}
+        for (id, key) in sorted(data):
+            self._write(id * 2 + int(key), data.pop((id, key)))
+        self.memory_used = 0
 
+    def _write(self, code, values):
+        payload = marshal.dumps(values)
+        if self._codes and code <= self._codes[-1]:
+            self._sorted = False
+        self._codes.append(code)
+        self._offsets.append(self._file.tell())
+        self._file.write(self.RECORD_HEADER.pack(code, len(payload)))
+        self._file.write(payload)
 
-def parse_bool(s):
-    return s == 't'
+    def _sort(self):
+        order = sorted(range(len(self._codes)), key=self._codes.__getitem__)
+        self._codes = array('l', (self._codes[i] for i in order))
+        self._offsets = array('l', (self._offsets[i] for i in order))
+        self._sorted = True
 
+    def __setitem__(self, item, values):
+        # Replaced rows are always kept in memory
+        self._data[item] = values
 
-ESCAPES = (('\\b', '\b'), ('\\f', '\f'), ('\\n', '\n'), ('\\r', '\r'),
-           ('\\t', '\t'), ('\\v', '\v'), ('\\\\', '\\'))
+    def get(self, item, default=None):
+        values = self._data.get(item)
+        if values is not None or self._file is None:
+            return default if values is None else values
+        id, key = item
+        code = id * 2 + int(key)
+        with self._lock:
+            if not self._sorted:
+                self._sort()
+            i = bisect.bisect_left(self._codes, code)
+            if i == len(self._codes) or self._codes[i] != code:
+                return default
+            self._file.seek(self._offsets[i])
+            stored_code, length = self.RECORD_HEADER.unpack(self._file.read(self.RECORD_HEADER.size))
+            return marshal.loads(self._file.read(length))
+
+    def close(self):
+        self._data = {}
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-def unescape(s):
-    if s == '\\N':
-        return None
-    for orig, repl in ESCAPES:
-        s = s.replace(orig, repl)
-    return s
 
+class StatementCache(object):
 
-def read_psql_dump(fp, types):
-    for line in fp:
-        values = map(unescape, line.rstrip('\r\n').split('\t'))
-        for i, value in enumerate(values):
-            if value is not None:
-                values[i] = types[i](value)
-        yield values
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._statements = OrderedDict()
+        self._counter = 0
+
+    def execute(self, cursor, shape, build_sql, params):
+        # build_sql(shape) must return the SQL with $1, $2, ... placeholders,
+        # it's only called the first time the shape is seen on this connection
+        name = self._statements.pop(shape, None)
+        if name is None:
+            self.misses += 1
+            if len(self._statements) >= self.size:
+                old_shape, old_name = self._statements.popitem(last=False)
+                cursor.execute('DEALLOCATE %s' % (old_name,))
+            self._counter += 1
+            name = 'mbslave_stmt_%d' % (self._counter,)
+            cursor.execute('PREPARE %s AS %s' % (name, build_sql(shape)))
+        else:
+            self.hits += 1
+        self._statements[shape] = name
+        if params:
+            cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+        else:
+            cursor.execute('EXECUTE %s' % (name,))
+
+
+def prepared_change_sql(shape):
+    type, fulltable, value_columns, key_columns, null_columns = shape
+    placeholders = ['$%d' % (i + 1) for i in range(len(value_columns))]
+    if type == 'd':
+        sql = 'DELETE FROM %s' % (fulltable,)
+    elif type == 'u':
+        sql_values = ', '.join('%s=%s' % i for i in zip(value_columns, placeholders))
+        sql = 'UPDATE %s SET %s' % (fulltable, sql_values)
+    elif type == 'i':
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (fulltable, ', '.join(value_columns), ', '.join(placeholders))
+    if type == 'd' or type == 'u':
+        conditions = ['%s=$%d' % (i, len(value_columns) + n + 1) for n, i in enumerate(key_columns)]
+        conditions += ['%s IS NULL' % i for i in null_columns]
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return sql
+
+
+UNIQUE_KEYS_SQL = """
+SELECT n.nspname, c.relname, i.indisprimary, i.indexprs IS NOT NULL,
+    ARRAY(SELECT a.attname::text FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k (attnum, pos)
+          JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum ORDER BY k.pos)
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE i.indisunique AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+ORDER BY i.indisprimary DESC
+"""
+
+FOREIGN_KEYS_SQL = """
+SELECT cn.nspname, c.relname,
+    ARRAY(SELECT a.attname::text FROM unnest(con.conkey) WITH ORDINALITY AS k (attnum, pos)
+          JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum ORDER BY k.pos),
+    rn.nspname, r.relname,
+    ARRAY(SELECT a.attname::text FROM unnest(con.confkey) WITH ORDINALITY AS k (attnum, pos)
+          JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum ORDER BY k.pos)
+FROM pg_constraint con
+JOIN pg_class c ON c.oid = con.conrelid
+JOIN pg_namespace cn ON cn.oid = c.relnamespace
+JOIN pg_class r ON r.oid = con.confrelid
+JOIN pg_namespace rn ON rn.oid = r.relnamespace
+WHERE con.contype = 'f'
+"""
+
+COLUMN_TYPES_SQL = """
+SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod)
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'p') AND a.attnum > 0 AND NOT a.attisdropped
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+"""
+
+TRIGGERS_SQL = """
+SELECT n.nspname, c.relname, t.tgname
+FROM pg_trigger t
+JOIN pg_class c ON c.oid = t.tgrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE NOT t.tgisinternal
+"""
+
+
+class ReplicaConstraints(object):
+    # Unique keys, foreign keys, triggers and column types of the tables in
+    # the replica, as installed, which decide what changes can be applied in
+    # parallel or in one batch
+
+    def __init__(self, db):
+        cursor = db.cursor()
+        self.primary_keys = {}
+        self.unique_keys = {}
+        self.expression_keys = set()
+        cursor.execute(UNIQUE_KEYS_SQL)
+        for schema, table, primary, expression, columns in cursor:
+            fulltable = fqn(schema, table)
+            if expression:
+                self.expression_keys.add(fulltable)
+                continue
+            if primary:
+                self.primary_keys[fulltable] = tuple(columns)
+            self.unique_keys.setdefault(fulltable, []).append(tuple(columns))
+        self.foreign_keys = {}
+        cursor.execute(FOREIGN_KEYS_SQL)
+        for schema, table, columns, referenced_schema, referenced_table, referenced_columns in cursor:
+            self.foreign_keys.setdefault(fqn(schema, table), []).append(
+                (tuple(columns), fqn(referenced_schema, referenced_table), tuple(referenced_columns)))
+        self.column_types = {}
+        cursor.execute(COLUMN_TYPES_SQL)
+        for schema, table, column, type in cursor:
+            self.column_types.setdefault(fqn(schema, table), {})[column] = type
+        # The Solr queue triggers only insert into their own table
+        self.triggers = {}
+        cursor.execute(TRIGGERS_SQL)
+        for schema, table, name in cursor:
+            if not name.startswith('mbslave_solr_'):
+                self.triggers.setdefault(fqn(schema, table), []).append(name)
+        db.rollback()
+
+
+class ApplyWorkers(object):
+    # Extra connections for applying the parts of a packet that don't depend
+    # on each other. Their transactions are prepared for two-phase commit and
+    # only committed after the main connection, whose transaction includes the
+    # replication_control update. If the script dies in between, prepared
+    # transactions of packets the replication sequence says were applied are
+    # committed on the next start, the others are rolled back.
+
+    def __init__(self, config, size, constraints):
+        self.connections = [connect_db(config) for i in range(size)]
+        if config.sync.prepare:
+            self.statements = [StatementCache(config.sync.prepare_cache_size) for i in range(size)]
+        else:
+            self.statements = [None] * size
+        self.prepared = []
+        cursor = self.connections[0].cursor()
+        cursor.execute("SELECT current_database(), current_setting('max_prepared_transactions')::int")
+        database, max_prepared = cursor.fetchone()
+        self.connections[0].rollback()
+        if max_prepared < size:
+            raise Exception("parallel=%d needs max_prepared_transactions of at least %d, the server has %d" % (size, size, max_prepared))
+        self.prefix = 'mbslave:%s:' % (database,)
+        self.constraints = constraints
+
+    def transaction_id(self, replication_seq, index):
+        return '%s%d:%d' % (self.prefix, replication_seq, index)
+
+    def recover(self, replication_seq):
+        db = self.connections[0]
+        cursor = db.cursor()
+        cursor.execute("SELECT gid FROM pg_prepared_xacts WHERE gid LIKE %s", (self.prefix + '%',))
+        gids = [gid for (gid,) in cursor if gid.startswith(self.prefix)]
+        db.rollback()
+        db.autocommit = True
+        try:
+            for gid in gids:
+                seq = int(gid[len(self.prefix):].split(':')[0])
+                if seq <= replication_seq:
+                    print 'Committing prepared transaction', gid
+                    cursor.execute("COMMIT PREPARED %s", (gid,))
+                else:
+                    print 'Rolling back prepared transaction', gid
+                    cursor.execute("ROLLBACK PREPARED %s", (gid,))
+        finally:
+            db.autocommit = False
+
+    def commit(self):
+        for db in self.prepared:
+            db.tpc_commit()
+        self.prepared = []
+
+    def rollback(self):
+        for db in self.prepared:
+            db.tpc_rollback()
+        self.prepared = []
+
+
+CHANGE_NAMES = {'d': 'delete', 'u': 'update', 'i': 'insert'}
+
+# Runs of batchable changes shorter than this are applied row by row, building
+# the arrays of a set-based statement would cost more than it saves
+MIN_BATCH_SIZE = 5
+
+# Smaller packets are not worth splitting between connections
+PARALLEL_MIN_CHANGES = 1000
 
 
 class PacketImporter(object):
 
-    def __init__(self, db, config, ignored_schemas, ignored_tables, replication_seq, hook):
+    def __init__(self, db, config, ignored_schemas, ignored_tables, replication_seq, hook, statements=None, workers=None, timer=None, constraints=None):
         self._db = db
-        self._data = {}
+        self._data = PendingDataStore(config.sync.memory_limit * 1024 * 1024)
         self._transactions = {}
+        self._ignored_ids = set()
         self._config = config
         self._ignored_schemas = ignored_schemas
         self._ignored_tables = ignored_tables
         self._hook = hook
         self._replication_seq = replication_seq
+        self._statements = statements
+        self._workers = workers
+        self._constraints = constraints
+        self._timer = timer or PacketTimer()
+        self._hook_lock = threading.Lock()
+        self._before_types = set(type for type, name in CHANGE_NAMES.iteritems() if hook.overrides('before_' + name))
+        self._after_types = set(type for type, name in CHANGE_NAMES.iteritems() if hook.overrides('after_' + name))
+        self._before_batch = hook.overrides('before_batch')
+        self._after_batch = hook.overrides('after_batch')
+
+    def iter_lines(self, fp):
+        # Reads the file in large chunks, so that the time spent decompressing
+        # can be measured separately from parsing
+        rest = ''
+        while True:
+            with self._timer.phase('decompress'):
+                data = fp.read(1024 * 1024)
+            if not data:
+                break
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
 
     def load_pending_data(self, fp):
-        dump = read_psql_dump(fp, [int, parse_bool, parse_data_fields])
-        for id, key, values in dump:
-            self._data[(id, key)] = values
+        with self._timer.phase('parse'):
+            dump = read_psql_dump(self.iter_lines(fp), [int, parse_bool, parse_data_fields])
+            for id, key, values in dump:
+                # Only known if Pending was loaded first, which is the usual order in packets
+                if id in self._ignored_ids:
+                    continue
+                self._data.add(id, key, values)
 
     def load_pending(self, fp):
-        dump = read_psql_dump(fp, [int, str, str, int])
-        for id, table, type, xid in dump:
-            schema, table = parse_name(self._config, table)
-            transaction = self._transactions.setdefault(xid, [])
-            transaction.append((id, schema, table, type))
+        with self._timer.phase('parse'):
+            dump = read_psql_dump(self.iter_lines(fp), [int, str, str, int])
+            for id, table, type, xid in dump:
+                schema, table = parse_name(self._config, table)
+                if schema == '<ignore>' or schema in self._ignored_schemas or table in self._ignored_tables:
+                    self._ignored_ids.add(id)
+                    continue
+                transaction = self._transactions.setdefault(xid, [])
+                transaction.append((id, intern(schema), intern(table), intern(type)))
 
-    def process(self):
-        cursor = self._db.cursor()
-        stats = {}
-        self._hook.begin(self._replication_seq)
+    def close(self):
+        self._data.close()
+
+    def iter_operations(self):
         for xid in sorted(self._transactions.keys()):
             transaction = self._transactions[xid]
-            #print ' - Running transaction', xid
-            #print 'BEGIN; --', xid
             for id, schema, table, type in sorted(transaction):
-                if schema == '<ignore>':
-                    continue
-                if schema in self._ignored_schemas:
-                    continue
-                if table in self._ignored_tables:
-                    continue
-                fulltable = fqn(schema, table)
-                if fulltable not in stats:
-                    stats[fulltable] = {'d': 0, 'u': 0, 'i': 0}
-                stats[fulltable][type] += 1
-                keys = self._data.get((id, True), {})
+                yield xid, id, schema, table, type
+
+    def coalesce(self):
+        # Reduces the changes of each row to their net effect: insert+update
+        # becomes an insert, insert+delete disappears, update+update becomes
+        # one update and update+delete a delete. The result replaces the first
+        # change, so it's only merged if no change in between could depend on
+        # the order, i.e. no change on a table related by a foreign key and no
+        # update or delete of another row in the same table.
+        neighbours = {}
+        for table, referenced in load_foreign_keys(self._config):
+            neighbours.setdefault(table, set()).add(referenced)
+            neighbours.setdefault(referenced, set()).add(table)
+
+        operations = [list(op) for op in self.iter_operations()]
+        positions = {}
+        ud_positions = {}
+        key_columns = {}
+        for pos, (xid, id, schema, table, type) in enumerate(operations):
+            fulltable = fqn(schema, table)
+            positions.setdefault(fulltable, []).append(pos)
+            if type != 'i':
+                ud_positions.setdefault(fulltable, []).append(pos)
+                if fulltable not in key_columns:
+                    key_columns[fulltable] = tuple(sorted(self._data.get((id, True), {})))
+
+        def can_merge(fulltable, chain, pos):
+            for other in neighbours.get(fulltable, ()):
+                if other != fulltable and other in positions:
+                    others = positions[other]
+                    i = bisect.bisect_right(others, chain.pos)
+                    if i < len(others) and others[i] < pos:
+                        return False
+            if fulltable in neighbours.get(fulltable, ()):
+                others = positions[fulltable]
+            else:
+                others = ud_positions[fulltable]
+            between = bisect.bisect_left(others, pos) - bisect.bisect_right(others, chain.pos)
+            return between <= chain.merged
+
+        chains = {}
+        changed = {}
+        removed = set()
+        for pos, (xid, id, schema, table, type) in enumerate(operations):
+            fulltable = fqn(schema, table)
+            columns = key_columns.get(fulltable)
+            if not columns:
+                continue
+            if type == 'i':
                 values = self._data.get((id, False), {})
-                if type == 'd':
-                    sql = 'DELETE FROM %s' % (fulltable,)
-                    params = []
-                    self._hook.before_delete(table, keys)
-                elif type == 'u':
-                    sql_values = ', '.join('%s=%%s' % i for i in values)
-                    sql = 'UPDATE %s SET %s' % (fulltable, sql_values)
-                    params = values.values()
-                    self._hook.before_update(table, keys, values)
-                elif type == 'i':
-                    sql_columns = ', '.join(values.keys())
-                    sql_values = ', '.join(['%s'] * len(values))
-                    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (fulltable, sql_columns, sql_values)
-                    params = values.values()
-                    self._hook.before_insert(table, values)
-                if type == 'd' or type == 'u':
-                    sql += ' WHERE ' + ' AND '.join('%s%s%%s' % (i, ' IS ' if keys[i] is None else '=') for i in keys.keys())
-                    params.extend(keys.values())
-                #print sql, params
-                cursor.execute(sql, params)
-                if type == 'd':
-                    self._hook.after_delete(table, keys)
-                elif type == 'u':
-                    self._hook.after_update(table, keys, values)
-                elif type == 'i':
-                    self._hook.after_insert(table, values)
-            #print 'COMMIT; --', xid
+                if all(i in values for i in columns):
+                    row = fulltable, tuple(values[i] for i in columns)
+                    chains[row] = ChangeChain(pos, type, {}, values)
+                continue
+            keys = self._data.get((id, True), {})
+            row = fulltable, tuple(keys.get(i) for i in columns)
+            chain = chains.pop(row, None)
+            if chain is None or not can_merge(fulltable, chain, pos):
+                if type == 'u':
+                    chain = ChangeChain(pos, type, keys, self._data.get((id, False), {}))
+                    row = fulltable, tuple(chain.values.get(i, keys.get(i)) for i in columns)
+                    chains[row] = chain
+                continue
+            removed.add(pos)
+            if type == 'u':
+                chain.values = dict(chain.values)
+                chain.values.update(self._data.get((id, False), {}))
+                chain.merged += 1
+                changed[chain.pos] = chain
+                row = fulltable, tuple(chain.values.get(i, chain.keys.get(i)) for i in columns)
+                chains[row] = chain
+            elif chain.type == 'i':
+                removed.add(chain.pos)
+                changed.pop(chain.pos, None)
+            else:
+                chain.type = 'd'
+                chain.values = {}
+                changed[chain.pos] = chain
+
+        for pos, chain in changed.iteritems():
+            operation = operations[pos]
+            operation[4] = chain.type
+            self._data[(operation[1], False)] = chain.values
+        self._transactions = {}
+        for pos, (xid, id, schema, table, type) in enumerate(operations):
+            if pos not in removed:
+                self._transactions.setdefault(xid, []).append((id, schema, table, type))
+        return len(removed)
+
+    def load_old_rows(self, operations, columns):
+        # Returns the current values of the given columns of the rows that
+        # are updated or deleted, as text, keyed by (table, primary key)
+        wanted = {}
+        for xid, id, schema, table, type in operations:
+            fulltable = fqn(schema, table)
+            if type != 'i' and fulltable in columns:
+                keys = self._data.get((id, True), {})
+                primary_key = self._constraints.primary_keys[fulltable]
+                wanted.setdefault(fulltable, set()).add(tuple(keys.get(i) for i in primary_key))
+        rows = {}
+        cursor = self._db.cursor()
+        for fulltable, keys in wanted.iteritems():
+            primary_key = self._constraints.primary_keys[fulltable]
+            names = list(primary_key) + sorted(columns[fulltable] - set(primary_key))
+            keys = sorted(keys)
+            for i in range(0, len(keys), 1000):
+                cursor.execute('SELECT %s FROM %s WHERE (%s) IN %%s' % (
+                    ', '.join('%s::text' % name for name in names), fulltable, ', '.join(primary_key)),
+                    (tuple(keys[i:i + 1000]),))
+                for row in cursor:
+                    rows[(fulltable, row[:len(primary_key)])] = dict(zip(names, row))
+        return rows
+
+    def split_operations(self, size):
+        # Splits the changes into groups that don't touch the same rows. Two
+        # changes are kept together if they share the value of a primary or
+        # unique key, or if one of them references, through a foreign key, a
+        # row the other one changes. Old values of updated and deleted rows
+        # are read from the database. Each group is applied by one connection
+        # in the original order, the first one, with the replication_control
+        # update, by the main connection. All changes of tables without a
+        # primary key or with unique expression indexes are kept in one group.
+        # Returns None if the packet should be applied serially, because it's
+        # small, it can't be split or it changes a table with triggers.
+        operations = list(self.iter_operations())
+        if len(operations) < PARALLEL_MIN_CHANGES:
+            return None
+        constraints = self._constraints
+        tables = set(fqn(schema, table) for xid, id, schema, table, type in operations)
+        control_table = fqn(self._config.schema.name('musicbrainz'), 'replication_control')
+        if control_table not in tables:
+            return None
+        for table in sorted(tables):
+            if table in constraints.triggers:
+                print ' - Applying serially, %s has triggers %s' % (table, ', '.join(constraints.triggers[table]))
+                return None
+
+        # All changes of a grouped table are kept together, rows of unkeyed
+        # tables can't be told apart, so any reference to them joins the group
+        grouped = set([control_table])
+        unkeyed = set()
+        columns = {}
+        for table in tables:
+            if table in constraints.expression_keys:
+                grouped.add(table)
+            if table not in constraints.primary_keys:
+                grouped.add(table)
+                unkeyed.add(table)
+                continue
+            columns[table] = set()
+            for key in constraints.unique_keys[table]:
+                columns[table].update(key)
+            for key, referenced, referenced_key in constraints.foreign_keys.get(table, ()):
+                columns[table].update(key)
+        for xid, id, schema, table, type in operations:
+            fulltable = fqn(schema, table)
+            if fulltable not in unkeyed:
+                keys = self._data.get((id, type != 'i'), {})
+                if any(keys.get(i) is None for i in constraints.primary_keys[fulltable]):
+                    grouped.add(fulltable)
+                    unkeyed.add(fulltable)
+                    del columns[fulltable]
+        # Rows referenced by unkeyed tables aren't known either
+        for table in unkeyed:
+            for key, referenced, referenced_key in constraints.foreign_keys.get(table, ()):
+                grouped.add(referenced)
+        old_rows = self.load_old_rows(operations, columns)
+
+        parents = {}
+
+        def find(node):
+            parents.setdefault(node, node)
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+
+        def union(a, b):
+            parents[find(a)] = find(b)
+
+        def key_value(row, key):
+            value = tuple(row.get(i) for i in key)
+            if None in value:
+                return None
+            return value
+
+        references = []
+        for pos, (xid, id, schema, table, type) in enumerate(operations):
+            fulltable = fqn(schema, table)
+            if fulltable in grouped:
+                union(pos, ('table', fulltable))
+            if fulltable in unkeyed:
+                for key, referenced, referenced_key in constraints.foreign_keys.get(fulltable, ()):
+                    union(pos, ('table', referenced))
+                continue
+            keys = self._data.get((id, True), {})
+            values = self._data.get((id, False), {})
+            # The row before and after the change, as far as it's known
+            rows = []
+            if type != 'i':
+                old = old_rows.get((fulltable, tuple(keys[i] for i in constraints.primary_keys[fulltable])))
+                if old is None:
+                    # Inserted by an earlier change of this packet or missing,
+                    # the primary key links it to the earlier changes
+                    old = keys
+                rows.append(old)
+                if type == 'u':
+                    new = dict(old)
+                    new.update(values)
+                    rows.append(new)
+            else:
+                rows.append(values)
+            for row in rows:
+                for key in constraints.unique_keys[fulltable]:
+                    value = key_value(row, key)
+                    if value is not None:
+                        union(pos, ('key', fulltable, key, value))
+                for key, referenced, referenced_key in constraints.foreign_keys.get(fulltable, ()):
+                    value = key_value(row, key)
+                    if value is not None:
+                        if referenced in unkeyed:
+                            references.append((pos, ('table', referenced)))
+                        else:
+                            references.append((pos, ('key', referenced, referenced_key, value)))
+        # Rows that are not changed by the packet don't connect the changes
+        # referencing them
+        for pos, node in references:
+            if node in parents:
+                union(pos, node)
+
+        sizes = {}
+        for pos in range(len(operations)):
+            root = find(pos)
+            sizes[root] = sizes.get(root, 0) + 1
+        if len(sizes) < 2:
+            return None
+        # Largest groups first, each to the least loaded connection
+        control_root = find(('table', control_table))
+        assignment = {control_root: 0}
+        loads = [0] * (size + 1)
+        loads[0] = sizes.pop(control_root)
+        for root in sorted(sizes, key=sizes.get, reverse=True):
+            index = min(range(len(loads)), key=loads.__getitem__)
+            assignment[root] = index
+            loads[index] += sizes[root]
+        groups = [[] for i in range(size + 1)]
+        for pos, operation in enumerate(operations):
+            groups[assignment[find(pos)]].append(operation)
+        return groups
+
+    def iter_changes(self, operations=None):
+        if operations is None:
+            operations = self.iter_operations()
+        for xid, id, schema, table, type in operations:
+            keys = self._data.get((id, True), {})
+            values = self._data.get((id, False), {})
+            yield schema, table, type, keys, values
+
+    def iter_runs(self, changes):
+        # Groups consecutive changes of the same type on the same table
+        run = []
+        for change in changes:
+            if run and change[:3] != run[0][:3]:
+                yield run
+                run = []
+            run.append(change)
+        if run:
+            yield run
+
+    def iter_batches(self, changes):
+        # Groups consecutive changes of the same type on the same table and
+        # columns. An update batch never touches the same row twice, because
+        # UPDATE ... FROM would only apply one of the changes. Changes with
+        # NULL key values can't be joined on, so they are never batched.
+        batch = []
+        batch_shape = None
+        touched = set()
+        for change in changes:
+            schema, table, type, keys, values = change
+            if None in keys.values():
+                shape = None
+            else:
+                shape = (type, schema, table, tuple(sorted(keys)), tuple(sorted(values)))
+            if type == 'u' and shape is not None:
+                key_columns = shape[3]
+                old_key = tuple(keys[i] for i in key_columns)
+                new_key = tuple(values.get(i, keys[i]) for i in key_columns)
+            if batch and (shape is None or shape != batch_shape or
+                          (type == 'u' and (old_key in touched or new_key in touched))):
+                yield batch_shape, batch
+                batch = []
+                touched.clear()
+            batch_shape = shape
+            batch.append(change)
+            if type == 'u' and shape is not None:
+                touched.add(old_key)
+                touched.add(new_key)
+        if batch:
+            yield batch_shape, batch
+
+    def split_unique_moves(self, cursor, batches):
+        # UPDATE ... FROM changes the rows in no defined order, so a row can't
+        # take a unique value that an earlier row of the batch still has, as
+        # it could before the other row is changed. Such batches are ended
+        # before that row. Moves of the key columns are handled by
+        # iter_batches, the current values of other unique columns are read
+        # when the batch is reached, after the earlier batches were applied.
+        for shape, changes in batches:
+            if shape is None or shape[0] != 'u' or len(changes) < MIN_BATCH_SIZE:
+                yield shape, changes
+                continue
+            type, schema, table, key_columns, value_columns = shape
+            fulltable = fqn(schema, table)
+            unique_keys = [key for key in self._constraints.unique_keys.get(fulltable, ())
+                           if set(key) != set(key_columns) and set(key) & set(value_columns)]
+            if not unique_keys:
+                yield shape, changes
+                continue
+            names = list(key_columns) + sorted(set(sum(unique_keys, ())) - set(key_columns))
+            row_keys = [tuple(keys[i] for i in key_columns) for schema, table, change_type, keys, values in changes]
+            old_rows = {}
+            for i in range(0, len(row_keys), 1000):
+                cursor.execute('SELECT %s FROM %s WHERE (%s) IN %%s' % (
+                    ', '.join('%s::text' % name for name in names), fulltable, ', '.join(key_columns)),
+                    (tuple(row_keys[i:i + 1000]),))
+                for row in cursor:
+                    old_rows[row[:len(key_columns)]] = dict(zip(names, row))
+
+            def unique_values(row):
+                # NULL values never conflict
+                values = set()
+                for unique_key in unique_keys:
+                    value = tuple(row.get(i) for i in unique_key)
+                    if None not in value:
+                        values.add((unique_key, value))
+                return values
+
+            batch = []
+            old_values = set()
+            for change, key in zip(changes, row_keys):
+                old = old_rows.get(key, {})
+                new = dict(old)
+                new.update(change[4])
+                if batch and unique_values(new) & old_values:
+                    yield shape, batch
+                    batch = []
+                    old_values.clear()
+                batch.append(change)
+                old_values.update(unique_values(old))
+            yield shape, batch
+
+    def before_batch(self, table, type, changes):
+        with self._hook_lock:
+            self._hook.before_batch(table, type, [(keys, values) for schema, table, type, keys, values in changes])
+
+    def after_batch(self, table, type, changes):
+        with self._hook_lock:
+            self._hook.after_batch(table, type, [(keys, values) for schema, table, type, keys, values in changes])
+
+    def before_change(self, table, type, keys, values):
+        with self._hook_lock:
+            self._before_change(table, type, keys, values)
+
+    def _before_change(self, table, type, keys, values):
+        if type == 'd':
+            self._hook.before_delete(table, keys)
+        elif type == 'u':
+            self._hook.before_update(table, keys, values)
+        elif type == 'i':
+            self._hook.before_insert(table, values)
+
+    def after_change(self, table, type, keys, values):
+        with self._hook_lock:
+            self._after_change(table, type, keys, values)
+
+    def _after_change(self, table, type, keys, values):
+        if type == 'd':
+            self._hook.after_delete(table, keys)
+        elif type == 'u':
+            self._hook.after_update(table, keys, values)
+        elif type == 'i':
+            self._hook.after_insert(table, values)
+
+    def apply_change(self, cursor, statements, schema, table, type, keys, values):
+        if statements is not None:
+            self.apply_prepared_change(cursor, statements, schema, table, type, keys, values)
+            return
+        fulltable = fqn(schema, table)
+        if type == 'd':
+            sql = 'DELETE FROM %s' % (fulltable,)
+            params = []
+        elif type == 'u':
+            sql_values = ', '.join('%s=%%s' % i for i in values)
+            sql = 'UPDATE %s SET %s' % (fulltable, sql_values)
+            params = values.values()
+        elif type == 'i':
+            sql_columns = ', '.join(values.keys())
+            sql_values = ', '.join(['%s'] * len(values))
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (fulltable, sql_columns, sql_values)
+            params = values.values()
+        if type == 'd' or type == 'u':
+            sql += ' WHERE ' + ' AND '.join('%s%s%%s' % (i, ' IS ' if keys[i] is None else '=') for i in keys.keys())
+            params.extend(keys.values())
+        #print sql, params
+        cursor.execute(sql, params)
+
+    def apply_prepared_change(self, cursor, statements, schema, table, type, keys, values):
+        value_columns = sorted(values)
+        key_columns = sorted(i for i in keys if keys[i] is not None)
+        null_columns = sorted(i for i in keys if keys[i] is None)
+        params = [values[i] for i in value_columns]
+        if type == 'd' or type == 'u':
+            params.extend(keys[i] for i in key_columns)
+        shape = (type, fqn(schema, table), tuple(value_columns), tuple(key_columns), tuple(null_columns))
+        statements.execute(cursor, shape, prepared_change_sql, params)
+
+    def apply_batch(self, cursor, shape, changes):
+        type, schema, table, key_columns, value_columns = shape
+        fulltable = fqn(schema, table)
+        if type == 'i':
+            rows = [[values[i] for i in value_columns] for schema, table, type, keys, values in changes]
+            sql = 'COPY %s (%s) FROM STDIN' % (fulltable, ', '.join(value_columns))
+            cursor.copy_expert(sql, StringIO(format_copy_data(rows)))
+            return
+        # Updates and deletes join the rows of text arrays, one for each key
+        # column, named k0, k1, ..., and each value column, named v0, v1, ...,
+        # cast to the column types. There is no staging table, the prepared
+        # transactions of parallel apply can't touch temporary tables.
+        types = self._constraints.column_types[fulltable]
+        arrays = [[keys[i] for schema, table, change_type, keys, values in changes] for i in key_columns]
+        arrays += [[values[i] for schema, table, change_type, keys, values in changes] for i in value_columns]
+        key_names = ['b.k%d::%s' % (i, types[column]) for i, column in enumerate(key_columns)]
+        value_names = ['b.v%d::%s' % (i, types[column]) for i, column in enumerate(value_columns)]
+        sql_rows = 'unnest(%s) AS b (%s)' % (', '.join(['%s::text[]'] * len(arrays)),
+            ', '.join(['k%d' % i for i in range(len(key_columns))] + ['v%d' % i for i in range(len(value_columns))]))
+        sql_where = ' AND '.join('t.%s = %s' % i for i in zip(key_columns, key_names))
+        if type == 'u':
+            sql_values = ', '.join('%s = %s' % i for i in zip(value_columns, value_names))
+            cursor.execute('UPDATE %s AS t SET %s FROM %s WHERE %s' % (fulltable, sql_values, sql_rows, sql_where), arrays)
+        elif type == 'd':
+            cursor.execute('DELETE FROM %s AS t USING %s WHERE %s' % (fulltable, sql_rows, sql_where), arrays)
+
+    def apply_changes(self, cursor, statements, changes, stats):
+        if self._config.sync.batch:
+            batches = self.split_unique_moves(cursor, self.iter_batches(changes))
+        else:
+            batches = ((None, run) for run in self.iter_runs(changes))
+        for shape, changes in batches:
+            # All changes in a batch are of the same type on the same table.
+            # Row hooks are called around each change, unless the whole batch
+            # is applied at once.
+            schema, table, type = changes[0][:3]
+            fulltable = fqn(schema, table)
+            if fulltable not in stats:
+                stats[fulltable] = {'d': 0, 'u': 0, 'i': 0}
+            stats[fulltable][type] += len(changes)
+            batched = shape is not None and len(changes) >= MIN_BATCH_SIZE
+            before = type in self._before_types
+            after = type in self._after_types
+            if self._before_batch or (batched and before):
+                with self._timer.phase('hooks'):
+                    if self._before_batch:
+                        self.before_batch(table, type, changes)
+                    if batched and before:
+                        for schema, table, type, keys, values in changes:
+                            self.before_change(table, type, keys, values)
+            with self._timer.phase('apply', fulltable, len(changes)):
+                if batched:
+                    self.apply_batch(cursor, shape, changes)
+                elif before or after:
+                    for schema, table, type, keys, values in changes:
+                        if before:
+                            with self._timer.phase('hooks'):
+                                self.before_change(table, type, keys, values)
+                        self.apply_change(cursor, statements, schema, table, type, keys, values)
+                        if after:
+                            with self._timer.phase('hooks'):
+                                self.after_change(table, type, keys, values)
+                else:
+                    for schema, table, type, keys, values in changes:
+                        self.apply_change(cursor, statements, schema, table, type, keys, values)
+            if self._after_batch or (batched and after):
+                with self._timer.phase('hooks'):
+                    if batched and after:
+                        for schema, table, type, keys, values in changes:
+                            self.after_change(table, type, keys, values)
+                    if self._after_batch:
+                        self.after_batch(table, type, changes)
+
+    def apply_worker(self, index, operations, results):
+        db = self._workers.connections[index]
+        stats = {}
+        try:
+            db.tpc_begin(self._workers.transaction_id(self._replication_seq, index))
+            self.apply_changes(db.cursor(), self._workers.statements[index], self.iter_changes(operations), stats)
+            db.tpc_prepare()
+        except Exception:
+            results.append((index, None, sys.exc_info()))
+            try:
+                db.tpc_rollback()
+            except psycopg2.Error:
+                pass
+            return
+        results.append((index, stats, None))
+
+    def apply_parallel(self, groups, stats):
+        print ' - Applying in parallel, %s changes per connection' % ('/'.join(str(len(group)) for group in groups),)
+        results = []
+        threads = []
+        for index, operations in enumerate(groups[1:]):
+            if operations:
+                thread = threading.Thread(target=self.apply_worker, args=(index, operations, results))
+                thread.start()
+                threads.append(thread)
+        errors = []
+        try:
+            self.apply_changes(self._db.cursor(), self._statements, self.iter_changes(groups[0]), stats)
+        except:
+            errors.append(sys.exc_info())
+        for thread in threads:
+            thread.join()
+        for index, worker_stats, exc_info in results:
+            if exc_info is None:
+                self._workers.prepared.append(self._workers.connections[index])
+                # Rows of one table can be split between connections
+                for table, counts in worker_stats.iteritems():
+                    if table not in stats:
+                        stats[table] = {'d': 0, 'u': 0, 'i': 0}
+                    for type, count in counts.iteritems():
+                        stats[table][type] += count
+            else:
+                errors.append(exc_info)
+        if errors:
+            self._workers.rollback()
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def process(self, commit=True):
+        stats = {}
+        coalesced = None
+        if self._config.sync.coalesce:
+            with self._timer.phase('coalesce'):
+                coalesced = self.coalesce()
+        with self._timer.phase('hooks'):
+            self._hook.begin(self._replication_seq)
+        groups = None
+        if self._workers is not None:
+            groups = self.split_operations(len(self._workers.connections))
+        if groups is None:
+            self.apply_changes(self._db.cursor(), self._statements, self.iter_changes(), stats)
+        else:
+            self.apply_parallel(groups, stats)
         print ' - Statistics:'
         for table in sorted(stats.keys()):
             print '   * %-30s\t%d\t%d\t%d' % (table, stats[table]['i'], stats[table]['u'], stats[table]['d'])
-        self._hook.before_commit()
-        self._db.commit()
-        self._hook.after_commit()
+            self._timer.count(table, stats[table])
+        if coalesced is not None:
+            print ' - Coalesced: %d changes removed' % (coalesced,)
+        if self._statements is not None:
+            print ' - Prepared statements: %d hits, %d misses' % (self._statements.hits, self._statements.misses)
+        if commit:
+            with self._timer.phase('hooks'):
+                self._hook.before_commit()
+            with self._timer.phase('commit'):
+                self._db.commit()
+                if self._workers is not None:
+                    self._workers.commit()
+            with self._timer.phase('hooks'):
+                self._hook.after_commit()
+        return sum(sum(counts.values()) for counts in stats.itervalues())
 
 
-def process_tar(fileobj, db, schema, ignored_schemas, ignored_tables, expected_schema_seq, replication_seq, hook):
+def parse_timestamp(ts):
+    # Returns the packet timestamp, e.g. 2019-05-13 12:00:01.834279+00, as a UNIX time
+    match = re.match(r'(\d+-\d+-\d+ \d+:\d+:\d+)(?:\.\d+)?(?:([+-])(\d\d):?(\d\d)?)?$', ts)
+    if match is None:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%d %H:%M:%S'))
+    if match.group(2):
+        offset = int(match.group(3)) * 3600 + int(match.group(4) or 0) * 60
+        if match.group(2) == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+    return seconds
+
+
+def process_tar(fileobj, db, schema, ignored_schemas, ignored_tables, expected_schema_seq, replication_seq, hook, statements=None, workers=None, timer=None, commit=True, constraints=None):
     print "Processing", fileobj.name
-    tar = tarfile.open(fileobj=fileobj, mode='r:bz2')
-    importer = PacketImporter(db, schema, ignored_schemas, ignored_tables, replication_seq, hook)
-    for member in tar:
-        if member.name == 'SCHEMA_SEQUENCE':
-            schema_seq = int(tar.extractfile(member).read().strip())
-            if schema_seq != expected_schema_seq:
-                raise Exception("Mismatched schema sequence, %d (database) vs %d (replication packet)" % (expected_schema_seq, schema_seq))
-        elif member.name == 'TIMESTAMP':
-            ts = tar.extractfile(member).read().strip()
-            print ' - Packet was produced at', ts
-        elif member.name in ('mbdump/Pending', 'mbdump/dbmirror_pending'):
-            importer.load_pending(tar.extractfile(member))
-        elif member.name in ('mbdump/PendingData', 'mbdump/dbmirror_pendingdata'):
-            importer.load_pending_data(tar.extractfile(member))
-    importer.process()
-
-
-def download_packet(base_url, token, replication_seq):
-    url = base_url.rstrip("/") + "/replication-%d.tar.bz2" % replication_seq
-    if token:
-        url += '?token=' + token
-    print "Downloading", url
+    ts = None
+    if timer is None:
+        timer = PacketTimer()
+    importer = PacketImporter(db, schema, ignored_schemas, ignored_tables, replication_seq, hook, statements, workers, timer, constraints)
+    with BZ2TarFile(fileobj, schema) as tar, timer.phase('decompress'):
+        for member in tar:
+            if member.name == 'SCHEMA_SEQUENCE':
+                schema_seq = int(tar.extractfile(member).read().strip())
+                if schema_seq != expected_schema_seq:
+                    raise Exception("Mismatched schema sequence, %d (database) vs %d (replication packet)" % (expected_schema_seq, schema_seq))
+            elif member.name == 'TIMESTAMP':
+                ts = tar.extractfile(member).read().strip()
+                print ' - Packet was produced at', ts
+            elif member.name in ('mbdump/Pending', 'mbdump/dbmirror_pending'):
+                importer.load_pending(tar.extractfile(member))
+            elif member.name in ('mbdump/PendingData', 'mbdump/dbmirror_pendingdata'):
+                importer.load_pending_data(tar.extractfile(member))
     try:
-        data = urllib2.urlopen(url, timeout=60)
-    except urllib2.HTTPError, e:
-        if e.code == 404:
-            return None
-        raise
-    tmp = tempfile.NamedTemporaryFile(suffix='.tar.bz2')
-    shutil.copyfileobj(data, tmp)
-    data.close()
-    tmp.seek(0)
-    return tmp
+        rows = importer.process(commit)
+    finally:
+        importer.close()
+    return ts, rows
+
+
+parser = OptionParser()
+parser.add_option("-c", "--config", dest="config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mbslave.conf'), help="path to the config file")
+parser.add_option("--packet-dir", dest="packet_dir", help="apply packets from a local directory instead of downloading them")
+parser.add_option("--daemon", dest="daemon", action="store_true", default=False, help="keep running and poll for new packets")
+parser.add_option("--timing", dest="timing", action="store_true", default=False, help="print the time spent in each phase and table")
+parser.add_option("--profile", dest="profile", metavar="FILE", help="profile the main thread with cProfile and save the stats to FILE")
+options, args = parser.parse_args()
 
-config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mbslave.conf'))
-db = connect_db(config)
+config = Config(options.config)
 
 base_url = config.get('MUSICBRAINZ', 'base_url')
 if config.has_option('MUSICBRAINZ', 'token'):
@@ -174,26 +1019,254 @@ ignored_tables = set(config.get('TABLES', 'ignore').split(','))
 
 hook_class = ReplicationHook
 
-cursor = db.cursor()
-cursor.execute("SELECT current_schema_sequence, current_replication_sequence FROM %s.replication_control" % config.schema.name('musicbrainz'))
-schema_seq, replication_seq = cursor.fetchone()
+if options.packet_dir:
+    fetch_packet = lambda seq: open_local_packet(options.packet_dir, seq)
+else:
+    if config.sync.packet_cache:
+        cache = PacketCache(config.sync.packet_cache, config.sync.packet_cache_size * 1024 * 1024,
+                            config.sync.packet_cache_age * 86400)
+    else:
+        cache = None
+    fetch_packet = lambda seq: download_packet(base_url, token, seq, cache)
 
-status = StatusReport(schema_seq, replication_seq)
-if config.monitoring.enabled:
-    status.load(config.monitoring.status_file)
+db = None
+statements = None
+constraints = None
+workers = None
+status = None
+
+
+def connect():
+    global db, statements, constraints, workers
+    db = connect_db(config)
+    # Prepared statements live as long as the connection, so the cache is shared by all packets
+    if config.sync.prepare:
+        statements = StatementCache(config.sync.prepare_cache_size)
+    else:
+        statements = None
+    # Batches need the column types, parallel apply the keys of the tables
+    if config.sync.batch or config.sync.parallel:
+        constraints = ReplicaConstraints(db)
+    else:
+        constraints = None
+    if config.sync.parallel:
+        workers = ApplyWorkers(config, config.sync.parallel, constraints)
+    else:
+        workers = None
+
+
+def disconnect():
+    global db, workers
+    for connection in [db] + (workers.connections if workers is not None else []):
+        if connection is not None:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+    db = None
+    workers = None
+
+
+def read_replication_control():
+    cursor = db.cursor()
+    cursor.execute("SELECT current_schema_sequence, current_replication_sequence, last_replication_date FROM %s.replication_control" % config.schema.name('musicbrainz'))
+    schema_seq, replication_seq, last_replication_date = cursor.fetchone()
+    if last_replication_date is not None:
+        last_replication_date = calendar.timegm(last_replication_date.utctimetuple())
+    return schema_seq, replication_seq, last_replication_date
 
-while True:
-    replication_seq += 1
-    hook = hook_class(config, db, config)
-    tmp = download_packet(base_url, token, replication_seq)
-    if tmp is None:
-        print 'Not found, stopping'
-        status.end()
-        break
-    process_tar(tmp, db, config, ignored_schemas, ignored_tables, schema_seq, replication_seq, hook)
-    tmp.close()
-    status.update(replication_seq)
 
-if config.monitoring.enabled:
-    status.save(config.monitoring.status_file)
+def is_catching_up(ts, packets, started, rows):
+    # When the replica is far behind, packets are applied in one transaction
+    # until one of the limits is reached. A packet applied in parallel is
+    # committed right away, the next packet would wait for the locks held by
+    # the prepared transactions.
+    if not config.sync.catchup_lag or ts is None:
+        return False
+    if workers is not None and workers.prepared:
+        return False
+    produced = parse_timestamp(ts)
+    if produced is None or time.time() - produced < config.sync.catchup_lag:
+        return False
+    if config.sync.catchup_packets and packets >= config.sync.catchup_packets:
+        return False
+    if config.sync.catchup_time and time.time() - started >= config.sync.catchup_time:
+        return False
+    if config.sync.catchup_rows and rows >= config.sync.catchup_rows:
+        return False
+    return True
 
+
+def commit(hook, packets, timer):
+    with timer.phase('hooks'):
+        hook.before_commit()
+    with timer.phase('commit'):
+        db.commit()
+        if workers is not None:
+            workers.commit()
+    with timer.phase('hooks'):
+        hook.after_commit()
+    if len(packets) > 1:
+        print 'Committed packets %d-%d' % (packets[0], packets[-1])
+    status.update(packets[-1])
+
+
+def report_timing(hook, timer, replication_seq, ts, rows):
+    if options.timing:
+        print timer.format()
+    report_dir = config.monitoring.report_dir
+    if report_dir:
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        path = os.path.join(report_dir, 'replication-%d.json' % replication_seq)
+        timer.save(path, replication_seq=replication_seq, timestamp=ts, rows=rows)
+    hook.timing(replication_seq, timer.report())
+
+
+def apply_packets(schema_seq, replication_seq):
+    # Applies the packets following replication_seq until one is not found,
+    # returns the number of applied packets and the timestamp of the last one
+    if config.sync.prefetch:
+        prefetcher = PacketPrefetcher(fetch_packet, replication_seq + 1, config.sync.prefetch)
+        fetch = prefetcher.get
+    else:
+        prefetcher = None
+        fetch = fetch_packet
+    applied = 0
+    last_ts = None
+    hook = None
+    uncommitted = []
+    try:
+        while True:
+            replication_seq += 1
+            timer = PacketTimer()
+            with timer.phase('download'):
+                tmp = fetch(replication_seq)
+            if tmp is None:
+                break
+            if hook is None:
+                hook = hook_class(config, db, config)
+                transaction_started = time.time()
+                transaction_rows = 0
+            uncommitted.append(replication_seq)
+            # The worker connections wouldn't see the changes of the earlier
+            # packets in the transaction, so those are applied serially
+            packet_workers = workers if len(uncommitted) == 1 else None
+            ts, rows = process_tar(tmp, db, config, ignored_schemas, ignored_tables, schema_seq, replication_seq, hook, statements, packet_workers, timer, commit=False, constraints=constraints)
+            tmp.close()
+            applied += 1
+            last_ts = ts
+            transaction_rows += rows
+            if is_catching_up(ts, len(uncommitted), transaction_started, transaction_rows):
+                print ' - Catching up, not committing yet'
+                report_timing(hook, timer, replication_seq, ts, rows)
+                continue
+            commit(hook, uncommitted, timer)
+            report_timing(hook, timer, replication_seq, ts, rows)
+            hook = None
+            uncommitted = []
+        if uncommitted:
+            commit(hook, uncommitted, timer)
+        else:
+            # Don't stay idle in the transaction that read replication_control
+            db.rollback()
+    except:
+        if uncommitted:
+            try:
+                db.rollback()
+                if workers is not None:
+                    workers.rollback()
+            except psycopg2.Error:
+                # The connection is gone, so is the transaction
+                pass
+            print 'Rolled back packets %d-%d' % (uncommitted[0], uncommitted[-1])
+        raise
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    return applied, last_ts
+
+
+def next_poll_delay(last_produced, misses):
+    # Packets are produced every publish_interval seconds, so after applying
+    # one there is no point in polling before the next one is due. Polls that
+    # don't find it are repeated with exponentially growing delays.
+    if misses == 0 and last_produced is not None:
+        due = last_produced + config.sync.publish_interval - time.time()
+        if due > 0:
+            return due
+    return min(config.sync.poll_delay * 2 ** max(misses - 1, 0), config.sync.poll_max_delay)
+
+
+if options.profile:
+    profiler = cProfile.Profile()
+    profiler.enable()
+else:
+    profiler = None
+
+# Database connection problems and failed downloads, other errors, e.g. a
+# corrupt packet or a full disk, would only happen again
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, urllib2.URLError,
+                    httplib.HTTPException, socket.error, IncompleteDownload)
+
+misses = 0
+errors = 0
+try:
+    while True:
+        try:
+            if db is None:
+                connect()
+            schema_seq, replication_seq, last_produced = read_replication_control()
+            if workers is not None:
+                workers.recover(replication_seq)
+            if status is None:
+                status = StatusReport(schema_seq, replication_seq)
+                if config.monitoring.enabled:
+                    status.load(config.monitoring.status_file)
+            if config.sync.defer_indexes:
+                lag = time.time() - last_produced if last_produced is not None else 0
+                if config.sync.defer_indexes_lag and lag > config.sync.defer_indexes_lag:
+                    defer_indexes(db, config, config.sync.defer_indexes)
+            try:
+                applied, last_ts = apply_packets(schema_seq, replication_seq)
+            except:
+                # Also after a failure, the indexes are needed while the replica
+                # is stuck, but not before a retry, which keeps them deferred
+                retry = options.daemon and isinstance(sys.exc_info()[1], RETRYABLE_ERRORS)
+                if config.sync.defer_indexes and not retry:
+                    rebuild_deferred_indexes(config, config.sync.defer_indexes_workers)
+                raise
+            if config.sync.defer_indexes:
+                rebuild_deferred_indexes(config, config.sync.defer_indexes_workers)
+        except RETRYABLE_ERRORS, e:
+            # Database connection problems and failed downloads are retried,
+            # the replica continues from the sequence in replication_control
+            if not options.daemon:
+                raise
+            delay = min(config.sync.poll_delay * 2 ** errors, config.sync.poll_max_delay)
+            errors += 1
+            print 'Error: %s, retrying in %d seconds' % (str(e).strip(), delay)
+            if isinstance(e, psycopg2.Error):
+                disconnect()
+            time.sleep(delay)
+            continue
+        errors = 0
+        status.end()
+        if config.monitoring.enabled:
+            status.save(config.monitoring.status_file)
+        if not options.daemon:
+            print 'Not found, stopping'
+            break
+        if applied:
+            misses = 0
+            if last_ts is not None:
+                last_produced = parse_timestamp(last_ts)
+        delay = next_poll_delay(last_produced, misses)
+        misses += 1
+        print 'Not found, checking again in %d seconds' % (delay,)
+        sys.stdout.flush()
+        time.sleep(delay)
+finally:
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
@@ -0,0 +1,242 @@
+import os
+import bz2
+import tarfile
+import threading
+import subprocess
+import multiprocessing
+from collections import deque
+from binascii import hexlify, unhexlify
+from distutils.spawn import find_executable
+
+
+BLOCK_MAGIC = 0x314159265359
+STREAM_END_MAGIC = 0x177245385090
+
+READ_SIZE = 4 * 1024 * 1024
+
+
+def make_needles(magic):
+    # bzip2 blocks are not byte aligned, so for each of the 8 possible bit
+    # offsets we search for the bytes fully covered by the 48-bit magic and
+    # check the partial bytes around them afterwards
+    needles = []
+    for shift in range(8):
+        value = magic << (8 - shift)
+        data = unhexlify('%014x' % value)
+        first = 0 if shift == 0 else 1
+        if shift == 0:
+            checks = []
+        else:
+            head_mask = (1 << (8 - shift)) - 1
+            tail_mask = (0xFF << (8 - shift)) & 0xFF
+            checks = [(0, head_mask, ord(data[0]) & head_mask), (6, tail_mask, ord(data[6]) & tail_mask)]
+        needles.append((shift, data[first:6], first, checks))
+    return needles
+
+
+BLOCK_NEEDLES = make_needles(BLOCK_MAGIC)
+STREAM_END_NEEDLES = make_needles(STREAM_END_MAGIC)
+
+
+def find_magic(data, needles, start, end):
+    # Returns bit offsets of all occurrences of the magic starting in data[start:end]
+    positions = []
+    for shift, needle, first, checks in needles:
+        i = data.find(needle, start + first)
+        while i != -1:
+            pos = i - first
+            if pos >= end:
+                break
+            if pos >= 0 and pos + 7 <= len(data):
+                if all(ord(data[pos + j]) & mask == expected for j, mask, expected in checks):
+                    positions.append(pos * 8 + shift)
+            i = data.find(needle, i + 1)
+    return positions
+
+
+def iter_blocks(fileobj):
+    # Yields (data, bit_offset, bit_length) for each compressed block, where
+    # the block starts at bit_offset in data, including its magic
+    data = ''
+    base = 0  # byte offset of data[0] in the file
+    scanned = 0  # bytes of data already searched for magic numbers
+    block_start = None
+    eof = False
+    while not eof:
+        chunk = fileobj.read(READ_SIZE)
+        if chunk:
+            data += chunk
+        else:
+            eof = True
+        # A magic number can start up to 7 bytes before the end of data
+        end = len(data) if eof else len(data) - 7
+        if end <= scanned:
+            continue
+        markers = [(pos, True) for pos in find_magic(data, BLOCK_NEEDLES, scanned, end)]
+        markers += [(pos, False) for pos in find_magic(data, STREAM_END_NEEDLES, scanned, end)]
+        scanned = end
+        for pos, is_block in sorted(markers):
+            if block_start is not None:
+                first_byte = block_start // 8
+                last_byte = (pos + 7) // 8
+                yield data[first_byte:last_byte], block_start - first_byte * 8, pos - block_start
+            block_start = pos if is_block else None
+        if block_start is None:
+            keep = scanned
+        else:
+            keep = min(block_start // 8, scanned)
+        if keep:
+            data = data[keep:]
+            base += keep
+            scanned -= keep
+            if block_start is not None:
+                block_start -= keep * 8
+    if block_start is not None:
+        raise IOError("Unexpected end of bzip2 data at byte %d" % (base + len(data)))
+
+
+def decompress_block(args):
+    # Wraps the block in a single-block bzip2 stream, its CRC is the stream CRC
+    data, offset, length = args
+    value = long(hexlify(data), 16)
+    value >>= len(data) * 8 - offset - length
+    value &= (1 << length) - 1
+    crc = (value >> (length - 80)) & 0xFFFFFFFF
+    value = (value << 80) | (STREAM_END_MAGIC << 32) | crc
+    bits = length + 80
+    padding = -bits % 8
+    value <<= padding
+    stream = unhexlify(('%x' % value).rjust((bits + padding) // 4, '0'))
+    return bz2.decompress('BZh9' + stream)
+
+
+class ParallelBZ2Reader(object):
+
+    def __init__(self, fileobj, workers):
+        self._blocks = iter_blocks(fileobj)
+        self._pool = multiprocessing.Pool(workers)
+        self._pending = deque()
+        self._max_pending = workers * 2
+        self._buffer = ''
+        self._pos = 0
+
+    def _fill(self):
+        for block in self._blocks:
+            self._pending.append(self._pool.apply_async(decompress_block, (block,)))
+            if len(self._pending) >= self._max_pending:
+                break
+        if not self._pending:
+            return False
+        try:
+            self._buffer = self._pending.popleft().get()
+        except (IOError, EOFError, ValueError), e:
+            raise IOError("Failed to decompress a bzip2 block (%s), try again with workers=1" % (e,))
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._buffer) and not self._fill():
+                break
+            if size < 0:
+                chunk = self._buffer[self._pos:]
+            else:
+                chunk = self._buffer[self._pos:self._pos + size]
+                size -= len(chunk)
+            self._pos += len(chunk)
+            chunks.append(chunk)
+            if size > 0:
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class ExternalBZ2Reader(object):
+
+    def __init__(self, fileobj, program, workers):
+        self._program = program
+        if 'pbzip2' in program:
+            args = [program, '-d', '-c', '-p%d' % workers]
+        else:
+            args = [program, '-d', '-c', '-n', str(workers)]
+        if isinstance(getattr(fileobj, 'file', fileobj), file):
+            # The process reads from the file descriptor, which can be at a
+            # different position than the buffered Python file object
+            os.lseek(fileobj.fileno(), fileobj.tell(), os.SEEK_SET)
+            self._process = subprocess.Popen(args, stdin=fileobj, stdout=subprocess.PIPE)
+            self._feeder = None
+        else:
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._feeder = threading.Thread(target=self._feed, args=(fileobj,))
+            self._feeder.daemon = True
+            self._feeder.start()
+
+    def _feed(self, fileobj):
+        try:
+            while True:
+                chunk = fileobj.read(READ_SIZE)
+                if not chunk:
+                    break
+                self._process.stdin.write(chunk)
+        except IOError:
+            pass
+        finally:
+            self._process.stdin.close()
+
+    def read(self, size=-1):
+        data = self._process.stdout.read(size)
+        if not data and self._process.wait() != 0:
+            raise IOError("%s exited with status %d" % (self._program, self._process.returncode))
+        return data
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.stdout.close()
+        self._process.wait()
+
+
+def find_program():
+    for name in ('lbzip2', 'pbzip2'):
+        path = find_executable(name)
+        if path:
+            return path
+    return None
+
+
+def open_bz2(fileobj, workers=1, program=None):
+    # Returns a file-like object with the decompressed data, or None if the
+    # data should be decompressed by the standard library
+    if workers <= 1:
+        return None
+    if program is None:
+        program = find_program()
+    if program:
+        return ExternalBZ2Reader(fileobj, program, workers)
+    return ParallelBZ2Reader(fileobj, workers)
+
+
+class BZ2TarFile(object):
+    # Context manager around tarfile, reading in stream mode when the data
+    # is decompressed by a parallel backend
+
+    def __init__(self, fileobj, cfg):
+        self.reader = open_bz2(fileobj, cfg.bzip2.workers, cfg.bzip2.program)
+        if self.reader is None:
+            # Streams that can't seek, like downloads, are read in order
+            mode = 'r:bz2' if hasattr(fileobj, 'seek') else 'r|bz2'
+            self.tar = tarfile.open(fileobj=fileobj, mode=mode)
+        else:
+            self.tar = tarfile.open(fileobj=self.reader, mode='r|')
+
+    def __enter__(self):
+        return self.tar
+
+    def __exit__(self, *exc_info):
+        self.tar.close()
+        if self.reader is not None:
+            self.reader.close()
@@ -17,6 +17,11 @@ class SolrConfig(object):
         self.index_release_groups = True
         self.index_recordings = True
         self.index_works = True
+        self.batch_docs = 1000
+        self.batch_size = 16
+        self.queue_chunk_size = 10000
+        self.format = 'xml'
+        self.query = 'merge'
 
     def parse(self, parser, section):
         if parser.has_option(section, 'enabled'):
@@ -27,6 +32,16 @@ class SolrConfig(object):
             key = 'index_%s' % name
             if parser.has_option(section, key):
                 setattr(self, key, parser.getboolean(section, key))
+        if parser.has_option(section, 'batch_docs'):
+            self.batch_docs = parser.getint(section, 'batch_docs')
+        if parser.has_option(section, 'batch_size'):
+            self.batch_size = parser.getint(section, 'batch_size')
+        if parser.has_option(section, 'queue_chunk_size'):
+            self.queue_chunk_size = parser.getint(section, 'queue_chunk_size')
+        if parser.has_option(section, 'format'):
+            self.format = parser.get(section, 'format')
+        if parser.has_option(section, 'query'):
+            self.query = parser.get(section, 'query')
 
 
 class MonitoringConfig(object):
@@ -34,12 +49,110 @@ class MonitoringConfig(object):
     def __init__(self):
         self.enabled = False
         self.status_file = '/tmp/mbslave-status.xml'
+        self.report_dir = None
 
     def parse(self, parser, section):
         if parser.has_option(section, 'enabled'):
             self.enabled = parser.getboolean(section, 'enabled')
         if parser.has_option(section, 'status_file'):
             self.status_file = parser.get(section, 'status_file')
+        if parser.has_option(section, 'report_dir'):
+            self.report_dir = parser.get(section, 'report_dir') or None
+
+
+class SyncConfig(object):
+
+    def __init__(self):
+        self.batch = False
+        self.coalesce = False
+        self.prepare = False
+        self.prepare_cache_size = 100
+        self.memory_limit = 0
+        self.prefetch = 0
+        self.parallel = 0
+        self.packet_cache = None
+        self.packet_cache_size = 1024
+        self.packet_cache_age = 0
+        self.catchup_lag = 0
+        self.catchup_packets = 24
+        self.catchup_time = 600
+        self.catchup_rows = 1000000
+        self.defer_indexes = []
+        self.defer_indexes_lag = 0
+        self.defer_indexes_workers = 2
+        self.publish_interval = 3600
+        self.poll_delay = 30
+        self.poll_max_delay = 600
+
+    def parse(self, parser, section):
+        if parser.has_option(section, 'batch'):
+            self.batch = parser.getboolean(section, 'batch')
+        if parser.has_option(section, 'coalesce'):
+            self.coalesce = parser.getboolean(section, 'coalesce')
+        if parser.has_option(section, 'prepare'):
+            self.prepare = parser.getboolean(section, 'prepare')
+        if parser.has_option(section, 'prepare_cache_size'):
+            self.prepare_cache_size = parser.getint(section, 'prepare_cache_size')
+        if parser.has_option(section, 'memory_limit'):
+            self.memory_limit = parser.getint(section, 'memory_limit')
+        if parser.has_option(section, 'prefetch'):
+            self.prefetch = parser.getint(section, 'prefetch')
+        if parser.has_option(section, 'parallel'):
+            self.parallel = parser.getint(section, 'parallel')
+        if parser.has_option(section, 'packet_cache'):
+            self.packet_cache = parser.get(section, 'packet_cache') or None
+        if parser.has_option(section, 'packet_cache_size'):
+            self.packet_cache_size = parser.getint(section, 'packet_cache_size')
+        if parser.has_option(section, 'packet_cache_age'):
+            self.packet_cache_age = parser.getint(section, 'packet_cache_age')
+        for name in ('lag', 'packets', 'time', 'rows'):
+            key = 'catchup_%s' % name
+            if parser.has_option(section, key):
+                setattr(self, key, parser.getint(section, key))
+        if parser.has_option(section, 'defer_indexes'):
+            self.defer_indexes = [name.strip() for name in parser.get(section, 'defer_indexes').split(',') if name.strip()]
+        for key in ('defer_indexes_lag', 'defer_indexes_workers', 'publish_interval', 'poll_delay', 'poll_max_delay'):
+            if parser.has_option(section, key):
+                setattr(self, key, parser.getint(section, key))
+
+
+class BZip2Config(object):
+
+    def __init__(self):
+        self.workers = 1
+        self.program = None
+
+    def parse(self, parser, section):
+        if parser.has_option(section, 'workers'):
+            self.workers = parser.getint(section, 'workers')
+        if parser.has_option(section, 'program'):
+            program = parser.get(section, 'program')
+            if program == 'none':
+                self.program = ''
+            else:
+                self.program = program or None
+
+
+class ImportConfig(object):
+
+    def __init__(self):
+        self.workers = 1
+        self.spool_dir = None
+        self.spool_size = 4096
+        self.freeze = False
+        self.diff_chunk_size = 10000
+
+    def parse(self, parser, section):
+        if parser.has_option(section, 'workers'):
+            self.workers = parser.getint(section, 'workers')
+        if parser.has_option(section, 'spool_dir'):
+            self.spool_dir = parser.get(section, 'spool_dir') or None
+        if parser.has_option(section, 'spool_size'):
+            self.spool_size = parser.getint(section, 'spool_size')
+        if parser.has_option(section, 'freeze'):
+            self.freeze = parser.getboolean(section, 'freeze')
+        if parser.has_option(section, 'diff_chunk_size'):
+            self.diff_chunk_size = parser.getint(section, 'diff_chunk_size')
 
 
 class SchemasConfig(object):
@@ -70,6 +183,15 @@ class Config(object):
         self.monitoring = MonitoringConfig()
         if self.cfg.has_section('monitoring'):
             self.monitoring.parse(self.cfg, 'monitoring')
+        self.sync = SyncConfig()
+        if self.cfg.has_section('sync'):
+            self.sync.parse(self.cfg, 'sync')
+        self.bzip2 = BZip2Config()
+        if self.cfg.has_section('bzip2'):
+            self.bzip2.parse(self.cfg, 'bzip2')
+        self.import_ = ImportConfig()
+        if self.cfg.has_section('import'):
+            self.import_.parse(self.cfg, 'import')
         self.schema = SchemasConfig()
         if self.cfg.has_section('schemas'):
             self.schema.parse(self.cfg, 'schemas')
@@ -0,0 +1,97 @@
+from itertools import izip
+
+
+ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+
+def unescape(s):
+    if s == '\\N':
+        return None
+    if '\\' not in s:
+        return s
+    # After splitting on backslashes, each part starts with the escaped
+    # character, except for empty parts, which come from escaped backslashes
+    parts = s.split('\\')
+    result = [parts[0]]
+    i = 1
+    n = len(parts)
+    while i < n:
+        part = parts[i]
+        if part:
+            c = part[0]
+            result.append(ESCAPES.get(c) or '\\' + c)
+            result.append(part[1:])
+            i += 1
+        elif i + 1 < n:
+            result.append('\\')
+            result.append(parts[i + 1])
+            i += 2
+        else:
+            result.append('\\')
+            i += 1
+    return ''.join(result)
+
+
+def escape(s):
+    if s is None:
+        return '\\N'
+    return s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_copy_data(rows):
+    return ''.join('\t'.join(map(escape, row)) + '\n' for row in rows)
+
+
+def parse_bool(s):
+    return s == 't'
+
+
+def parse_data_fields(s):
+    # The data is a sequence of "name"='value' pairs, each followed by a space,
+    # with quotes in values doubled and NULL values written as "name"=
+    fields = {}
+    pos = 0
+    end = len(s)
+    while pos < end:
+        if s[pos] != '"':
+            break
+        name_end = s.find('"', pos + 1)
+        if name_end == -1:
+            break
+        name = s[pos + 1:name_end]
+        pos = name_end + 2
+        if s[pos:pos + 1] == "'":
+            value_start = pos + 1
+            value_end = s.find("'", value_start)
+            while value_end != -1 and s[value_end + 1:value_end + 2] == "'":
+                value_end = s.find("'", value_end + 2)
+            if value_end == -1:
+                break
+            value = s[value_start:value_end]
+            if "''" in value:
+                value = value.replace("''", "'")
+            if '\\\\' in value:
+                value = value.replace("\\\\", "\\")
+            pos = value_end + 2
+        else:
+            value = None
+            pos += 1
+        fields[name] = value
+    return fields
+
+
+def format_data_fields(fields):
+    # The reverse of parse_data_fields, for a list of (name, value) pairs
+    result = []
+    for name, value in fields:
+        if value is None:
+            result.append('"%s"= ' % name)
+        else:
+            result.append('"%s"=\'%s\' ' % (name, value.replace("\\", "\\\\").replace("'", "''")))
+    return ''.join(result)
+
+
+def read_psql_dump(fp, types):
+    for line in fp:
+        fields = line.rstrip('\r\n').split('\t')
+        yield [None if value == '\\N' else type(unescape(value)) for type, value in izip(types, fields)]
@@ -0,0 +1,207 @@
+import re
+import hashlib
+import tempfile
+
+
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+RECORD_QUOTE_RE = re.compile(r'["\\(),\s]')
+
+PRIMARY_KEY_SQL = """
+SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+FROM pg_index i
+CROSS JOIN unnest(i.indkey::int2[]) WITH ORDINALITY AS k (attnum, pos)
+JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+WHERE i.indrelid = %s::regclass AND i.indisprimary
+ORDER BY k.pos
+"""
+
+TABLE_COLUMNS_SQL = """
+SELECT attname FROM pg_attribute
+WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+ORDER BY attnum
+"""
+
+# The text form of rows, which is hashed, must match the dump regardless of
+# the settings of the server or the user. The dumps are written in UTC with
+# ISO dates and exact floats, since PostgreSQL 12 in their shortest form.
+TEXT_OUTPUT_SETTINGS_SQL = """
+SET LOCAL TimeZone = 'UTC';
+SET LOCAL DateStyle = 'ISO, YMD';
+SET LOCAL IntervalStyle = 'postgres';
+SET LOCAL extra_float_digits = 3
+"""
+
+
+def decode_copy_field(value):
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return re.sub(r'\\(.)', lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def format_record_field(value):
+    # Same as the output of a record in PostgreSQL
+    if value is None:
+        return ''
+    if value == '':
+        return '""'
+    if RECORD_QUOTE_RE.search(value):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '""')
+    return value
+
+
+def row_hash(fields):
+    # Matches ('x' || substr(md5(t::text), 1, 15))::bit(60)::bigint
+    record = '(%s)' % ','.join(format_record_field(decode_copy_field(field)) for field in fields)
+    return int(hashlib.md5(record).hexdigest()[:15], 16)
+
+
+class TableChunks(object):
+    # Splits the rows of a table into chunks by the first column of the
+    # primary key, integer keys by ranges of chunk_size values, other keys by
+    # a hash of their value. The chunk of a row is computed the same way
+    # in SQL, so chunks of the dump and the table can be compared by the
+    # number of rows and the sum of their hashes. Rows of the chunks that
+    # differ are compared one by one, by the whole primary key. Only the
+    # columns of the dump are hashed, other columns of the table are left
+    # alone.
+
+    def __init__(self, db, fulltable, columns, chunk_size):
+        cursor = db.cursor()
+        cursor.execute(TABLE_COLUMNS_SQL, (fulltable,))
+        table_columns = set(name for (name,) in cursor)
+        missing = [name for name in columns if name not in table_columns]
+        if missing:
+            raise ValueError("table %s has no column %s" % (fulltable, ', '.join(missing)))
+        cursor.execute(PRIMARY_KEY_SQL, (fulltable,))
+        key = cursor.fetchall()
+        if not key:
+            raise ValueError("table %s has no primary key" % fulltable)
+        self.key = [name for name, type in key]
+        missing = [name for name in self.key if name not in columns]
+        if missing:
+            raise ValueError("the dump has no column %s" % ', '.join(missing))
+        self.key_positions = [columns.index(name) for name in self.key]
+        self.column, type = key[0]
+        self.position = columns.index(self.column)
+        self.columns = columns
+        self.fulltable = fulltable
+        if type in ('smallint', 'integer', 'bigint'):
+            self.size = chunk_size
+            self.buckets = None
+            self.expression = '(%s / %d)' % (self.column, self.size)
+        else:
+            cursor.execute("SELECT count(*) FROM %s" % fulltable)
+            self.size = None
+            self.buckets = max(1, cursor.fetchone()[0] // chunk_size)
+            self.expression = "mod(('x' || substr(md5(%s::text), 1, 8))::bit(32)::bigint, %d)" % (self.column, self.buckets)
+
+    def chunk(self, fields):
+        value = decode_copy_field(fields[self.position])
+        if self.buckets is None:
+            value = int(value)
+            # Integer division in PostgreSQL rounds towards zero
+            chunk = abs(value) // self.size
+            return -chunk if value < 0 else chunk
+        return int(hashlib.md5(value).hexdigest()[:8], 16) % self.buckets
+
+    def table_hashes(self, db):
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT %s, count(*), sum(('x' || substr(md5(ROW(%s)::text), 1, 15))::bit(60)::bigint)
+            FROM %s GROUP BY 1
+        """ % (self.expression, ', '.join(self.columns), self.fulltable))
+        return dict((chunk, (count, int(total))) for chunk, count, total in cursor)
+
+    def row_key(self, fields):
+        return tuple(decode_copy_field(fields[i]) for i in self.key_positions)
+
+    def row_hashes(self, db, chunks):
+        # Returns the hashes of the rows in the chunks, keyed by the primary
+        # key as text
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT %s, ('x' || substr(md5(ROW(%s)::text), 1, 15))::bit(60)::bigint
+            FROM %s WHERE %s = ANY(%%s)
+        """ % (', '.join('%s::text' % name for name in self.key), ', '.join(self.columns),
+               self.fulltable, self.expression), (sorted(chunks),))
+        return dict((row[:-1], int(row[-1])) for row in cursor)
+
+    def delete_rows(self, db, keys):
+        cursor = db.cursor()
+        keys = sorted(keys)
+        deleted = 0
+        for i in range(0, len(keys), 1000):
+            cursor.execute("DELETE FROM %s WHERE (%s) IN %%s" % (self.fulltable, ', '.join(self.key)), (tuple(keys[i:i + 1000]),))
+            deleted += cursor.rowcount
+        return deleted
+
+    def load_rows(self, db, fileobj):
+        # Updates the rows that exist and inserts the others, through a
+        # temporary table with the columns of the dump. Changed rows are
+        # not deleted, so rows referencing them by ON DELETE CASCADE foreign
+        # keys stay.
+        cursor = db.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE mbslave_diff ON COMMIT DROP AS SELECT %s FROM %s LIMIT 0" % (', '.join(self.columns), self.fulltable))
+        cursor.copy_from(fileobj, 'mbslave_diff', columns=self.columns)
+        sql_key = ' AND '.join('t.%s = s.%s' % (name, name) for name in self.key)
+        values = [name for name in self.columns if name not in self.key]
+        updated = 0
+        if values:
+            cursor.execute("UPDATE %s AS t SET %s FROM mbslave_diff AS s WHERE %s" % (
+                self.fulltable, ', '.join('%s = s.%s' % (name, name) for name in values), sql_key))
+            updated = cursor.rowcount
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM mbslave_diff AS s WHERE NOT EXISTS (SELECT 1 FROM %s AS t WHERE %s)" % (
+            self.fulltable, ', '.join(self.columns), ', '.join('s.%s' % name for name in self.columns), self.fulltable, sql_key))
+        return updated, cursor.rowcount
+
+
+def diff_table(db, fileobj, fulltable, columns, chunk_size):
+    # Updates the chunks of the table whose rows differ from the dump, the
+    # dump is copied to a temporary file while computing its hashes, and only
+    # rows from the differing chunks are compared with the table one by one.
+    # Rows missing from the dump are deleted, the others are updated or
+    # inserted if they differ or are missing in the table. The columns are
+    # those of the dump, if they are not known, the dump must have all
+    # columns of the table.
+    cursor = db.cursor()
+    cursor.execute(TEXT_OUTPUT_SETTINGS_SQL)
+    if columns is None:
+        cursor.execute(TABLE_COLUMNS_SQL, (fulltable,))
+        columns = [name for (name,) in cursor]
+    chunks = TableChunks(db, fulltable, columns, chunk_size)
+    hashes = {}
+    with tempfile.TemporaryFile(prefix='mbslave-diff-') as tmp:
+        for line in fileobj:
+            tmp.write(line)
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != len(columns):
+                raise ValueError("the dump has %d columns, expected %d" % (len(fields), len(columns)))
+            chunk = chunks.chunk(fields)
+            count, total = hashes.get(chunk, (0, 0))
+            hashes[chunk] = count + 1, total + row_hash(fields)
+        changed = set()
+        table_hashes = chunks.table_hashes(db)
+        for chunk in set(hashes) | set(table_hashes):
+            if hashes.get(chunk) != table_hashes.get(chunk):
+                changed.add(chunk)
+        if not changed:
+            db.rollback()
+            return 0, len(hashes), 0, 0, 0
+        table_rows = chunks.row_hashes(db, changed)
+        tmp.seek(0)
+        with tempfile.TemporaryFile(prefix='mbslave-diff-') as rows:
+            for line in tmp:
+                fields = line.rstrip('\n').split('\t')
+                if chunks.chunk(fields) not in changed:
+                    continue
+                # The rows left in table_rows are not in the dump
+                if table_rows.pop(chunks.row_key(fields), None) != row_hash(fields):
+                    rows.write(line)
+            deleted = chunks.delete_rows(db, table_rows)
+            rows.seek(0)
+            updated, inserted = chunks.load_rows(db, rows)
+        db.commit()
+    return len(changed), len(set(hashes) | set(table_hashes)), deleted, updated, inserted
@@ -0,0 +1,61 @@
+import time
+import socket
+import urllib2
+import httplib
+
+
+class HTTPStream(object):
+    # File-like object reading a URL from the start to the end. If the
+    # connection fails, it's opened again with a Range request starting at
+    # the first byte that wasn't read yet.
+
+    def __init__(self, url, retries=10, retry_delay=10, timeout=60):
+        self.url = url
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.pos = 0
+        self.size = None
+        self._response = self._open()
+
+    def _open(self):
+        request = urllib2.Request(self.url)
+        if self.pos:
+            request.add_header('Range', 'bytes=%d-' % self.pos)
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        if self.pos:
+            content_range = response.info().getheader('Content-Range') or ''
+            if response.getcode() != 206 or not content_range.startswith('bytes %d-' % self.pos):
+                response.close()
+                raise IOError("Server doesn't support resuming the download of %s" % self.url)
+        else:
+            size = response.info().getheader('Content-Length')
+            if size is not None:
+                self.size = int(size)
+        return response
+
+    def read(self, size=-1):
+        failures = 0
+        while True:
+            try:
+                if self._response is None:
+                    self._response = self._open()
+                data = self._response.read(size)
+                if not data and size != 0 and self.size is not None and self.pos < self.size:
+                    raise IOError("connection closed after %d of %d bytes" % (self.pos, self.size))
+                self.pos += len(data)
+                return data
+            except (IOError, socket.error, httplib.HTTPException), e:
+                failures += 1
+                if failures > self.retries:
+                    raise
+                print "Download of %s failed at byte %d (%s), resuming in %d seconds" % (self.url, self.pos, e, self.retry_delay)
+                if self._response is not None:
+                    self._response.close()
+                    self._response = None
+                time.sleep(self.retry_delay)
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
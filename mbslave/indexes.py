@@ -0,0 +1,128 @@
+import sys
+import Queue
+import threading
+import psycopg2
+from mbslave import connect_db, parse_name, fqn, check_table_exists
+
+
+# Valid, non-unique indexes that no constraint depends on and whose leading
+# columns are not the columns of a foreign key on the same table, which are
+# needed to check deletes on the referenced table
+DEFERRABLE_INDEX_SQL = """
+SELECT pg_get_indexdef(i.indexrelid)
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s AND c.relname = %s
+    AND i.indisvalid AND NOT i.indisunique
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid)
+    AND NOT EXISTS (
+        SELECT 1 FROM pg_constraint con
+        WHERE con.contype = 'f' AND con.conrelid = i.indrelid
+            AND (string_to_array(i.indkey::text, ' ')::int2[])[1:array_length(con.conkey, 1)] <@ con.conkey
+            AND con.conkey <@ (string_to_array(i.indkey::text, ' ')::int2[])[1:array_length(con.conkey, 1)])
+"""
+
+INDEX_VALID_SQL = """
+SELECT i.indisvalid
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s AND c.relname = %s
+"""
+
+
+def deferred_index_table(cfg):
+    return fqn(cfg.schema.name('mbslave'), 'mbslave_deferred_index')
+
+
+def check_deferred_index_table(db, cfg):
+    if not check_table_exists(db, cfg.schema.name('mbslave'), 'mbslave_deferred_index'):
+        raise Exception("Table %s doesn't exist, create it using sql-extra/deferred-indexes.sql" % deferred_index_table(cfg))
+
+
+def defer_indexes(db, cfg, names):
+    # Drops the indexes and records their definitions in the same transaction,
+    # so an index is never missing without a record to rebuild it from
+    check_deferred_index_table(db, cfg)
+    cursor = db.cursor()
+    deferred = []
+    for name in names:
+        schema, name = parse_name(cfg, name)
+        cursor.execute("SELECT 1 FROM %s WHERE schema_name = %%s AND index_name = %%s" % deferred_index_table(cfg), (schema, name))
+        if cursor.fetchone() is not None:
+            continue
+        cursor.execute(DEFERRABLE_INDEX_SQL, (schema, name))
+        row = cursor.fetchone()
+        if row is None:
+            print ' - Not deferring index %s, it does not exist, is unique or is needed by a constraint' % fqn(schema, name)
+            continue
+        cursor.execute("INSERT INTO %s (schema_name, index_name, definition) VALUES (%%s, %%s, %%s)" % deferred_index_table(cfg),
+                       (schema, name, row[0]))
+        cursor.execute("DROP INDEX %s" % fqn(schema, name))
+        deferred.append(fqn(schema, name))
+    db.commit()
+    if deferred:
+        print ' - Deferred indexes', ', '.join(deferred)
+    return deferred
+
+
+def rebuild_index(db, cfg, schema, name, definition):
+    cursor = db.cursor()
+    cursor.execute(INDEX_VALID_SQL, (schema, name))
+    row = cursor.fetchone()
+    if row is not None and not row[0]:
+        # Left behind by an interrupted CREATE INDEX CONCURRENTLY
+        cursor.execute("DROP INDEX CONCURRENTLY %s" % fqn(schema, name))
+        row = None
+    if row is None:
+        print 'Rebuilding index', fqn(schema, name)
+        cursor.execute(definition.replace('CREATE INDEX ', 'CREATE INDEX CONCURRENTLY ', 1))
+    cursor.execute("DELETE FROM %s WHERE schema_name = %%s AND index_name = %%s" % deferred_index_table(cfg), (schema, name))
+
+
+def rebuild_deferred_indexes(cfg, workers=1):
+    # Rebuilds all recorded indexes without blocking queries, indexes that
+    # fail to build stay recorded and are tried again the next time
+    db = connect_db(cfg)
+    try:
+        check_deferred_index_table(db, cfg)
+        cursor = db.cursor()
+        cursor.execute("SELECT schema_name, index_name, definition FROM %s ORDER BY deferred" % deferred_index_table(cfg))
+        queue = Queue.Queue()
+        for row in cursor:
+            queue.put(row)
+        db.rollback()
+    finally:
+        db.close()
+    if queue.empty():
+        return True
+    errors = []
+
+    def run():
+        try:
+            db = connect_db(cfg)
+        except psycopg2.Error:
+            errors.append(sys.exc_info()[1])
+            return
+        db.autocommit = True
+        try:
+            while True:
+                try:
+                    schema, name, definition = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    rebuild_index(db, cfg, schema, name, definition)
+                except psycopg2.Error, e:
+                    print 'Failed to rebuild index %s: %s' % (fqn(schema, name), str(e).strip())
+                    errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=run) for i in range(min(workers, queue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return not errors
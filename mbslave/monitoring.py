@@ -1,4 +1,8 @@
 import os
+import time
+import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from xml.etree.ElementTree import ElementTree, Element, SubElement
 
@@ -50,3 +54,85 @@ class StatusReport(object):
         tree.write(path, encoding="UTF-8", xml_declaration=True)
 
 
+class PacketTimer(object):
+    # Wall and CPU time spent in each phase of applying a packet, and in each
+    # table. Time spent in a nested phase is only counted for the inner one.
+    # CPU time is for the whole process, so with parallel apply it includes
+    # the other threads.
+
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = time.clock()
+        self.phases = {}
+        self.tables = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def phase(self, name, table=None, rows=0):
+        stack = self._local.__dict__.setdefault('stack', [])
+        children = [0.0, 0.0]
+        stack.append(children)
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall
+            cpu = time.clock() - cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self.add(name, wall - children[0], cpu - children[1], table, rows)
+
+    def add(self, name, wall, cpu, table=None, rows=0):
+        with self._lock:
+            for key, entries in ((name, self.phases), (table, self.tables)):
+                if key is None:
+                    continue
+                entry = entries.get(key)
+                if entry is None:
+                    entry = entries[key] = {'wall': 0.0, 'cpu': 0.0, 'rows': 0}
+                entry['wall'] += wall
+                entry['cpu'] += cpu
+                entry['rows'] += rows
+
+    def count(self, table, counts):
+        # Adds the number of inserted, updated and deleted rows
+        with self._lock:
+            entry = self.tables.setdefault(table, {'wall': 0.0, 'cpu': 0.0, 'rows': 0})
+            entry.update(counts)
+
+    def report(self):
+        report = {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'wall': time.time() - self.started,
+            'cpu': time.clock() - self.cpu_started,
+            'phases': {},
+            'tables': {},
+        }
+        with self._lock:
+            for key, entries in (('phases', self.phases), ('tables', self.tables)):
+                for name, entry in entries.iteritems():
+                    entry = dict(entry)
+                    if entry['rows'] and entry['wall']:
+                        entry['rows_per_sec'] = entry['rows'] / entry['wall']
+                    report[key][name] = entry
+        return report
+
+    def format(self):
+        report = self.report()
+        lines = [' - Timing: %.2fs wall, %.2fs cpu' % (report['wall'], report['cpu'])]
+        for name, entry in sorted(report['phases'].items(), key=lambda i: -i[1]['wall']):
+            lines.append('   * %-30s\t%8.3fs\t%8.3fs' % (name, entry['wall'], entry['cpu']))
+        for name, entry in sorted(report['tables'].items(), key=lambda i: -i[1]['wall']):
+            lines.append('   * %-30s\t%8.3fs\t%8.3fs\t%d rows\t%d rows/sec' % (
+                name, entry['wall'], entry['cpu'], entry['rows'], entry.get('rows_per_sec', 0)))
+        return '\n'.join(lines)
+
+    def save(self, path, **extra):
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
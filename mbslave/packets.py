@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import Queue
+import shutil
+import hashlib
+import urllib2
+import tempfile
+import threading
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+def packet_name(replication_seq):
+    return "replication-%d.tar.bz2" % replication_seq
+
+
+def file_checksum(fp):
+    checksum = hashlib.sha256()
+    size = 0
+    while True:
+        data = fp.read(1024 * 1024)
+        if not data:
+            break
+        checksum.update(data)
+        size += len(data)
+    fp.seek(0)
+    return checksum.hexdigest(), size
+
+
+class PacketCache(object):
+    # Downloaded packets are stored as replication-N.tar.bz2, next to a
+    # replication-N.tar.bz2.sha256 file with their checksum and size. The
+    # least recently used packets are removed when the cache gets too big.
+
+    def __init__(self, path, max_size=0, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def open(self, replication_seq, required=True):
+        path = os.path.join(self.path, packet_name(replication_seq))
+        if not os.path.exists(path):
+            return None
+        fp = open(path, 'rb')
+        if os.path.exists(path + '.sha256'):
+            expected = open(path + '.sha256').read().split()
+            checksum, size = file_checksum(fp)
+            if expected != [checksum, str(size)]:
+                print ' - Packet %s is corrupted, checksum %s and size %d do not match' % (path, checksum, size)
+                fp.close()
+                return None
+        elif required:
+            fp.close()
+            return None
+        return fp
+
+    def get(self, replication_seq):
+        fp = self.open(replication_seq)
+        if fp is not None:
+            os.utime(fp.name, None)
+            print "Using cached", fp.name
+        return fp
+
+    def put(self, replication_seq, fp):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = os.path.join(self.path, packet_name(replication_seq))
+        checksum, size = file_checksum(fp)
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix='.tmp-', delete=False) as tmp:
+            shutil.copyfileobj(fp, tmp)
+        fp.seek(0)
+        os.rename(tmp.name, path)
+        with open(path + '.sha256', 'w') as f:
+            f.write('%s %d\n' % (checksum, size))
+        self.evict()
+
+    def evict(self):
+        packets = []
+        for name in os.listdir(self.path):
+            if name.startswith('replication-') and name.endswith('.tar.bz2'):
+                path = os.path.join(self.path, name)
+                stat = os.stat(path)
+                packets.append((stat.st_mtime, stat.st_size, path))
+        packets.sort()
+        total_size = sum(size for mtime, size, path in packets)
+        now = time.time()
+        for mtime, size, path in packets:
+            expired = self.max_age and now - mtime > self.max_age
+            if not expired and (not self.max_size or total_size <= self.max_size):
+                break
+            os.remove(path)
+            if os.path.exists(path + '.sha256'):
+                os.remove(path + '.sha256')
+            total_size -= size
+
+
+def download_packet(base_url, token, replication_seq, cache=None):
+    if cache is not None:
+        tmp = cache.get(replication_seq)
+        if tmp is not None:
+            return tmp
+    url = base_url.rstrip("/") + "/" + packet_name(replication_seq)
+    if token:
+        url += '?token=' + token
+    print "Downloading", url
+    try:
+        data = urllib2.urlopen(url, timeout=60)
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            return None
+        raise
+    tmp = tempfile.NamedTemporaryFile(suffix='.tar.bz2')
+    shutil.copyfileobj(data, tmp)
+    data.close()
+    expected_size = data.info().getheader('Content-Length')
+    if expected_size is not None and int(expected_size) != tmp.tell():
+        raise IncompleteDownload("Incomplete download of %s, got %d of %s bytes" % (url, tmp.tell(), expected_size))
+    tmp.seek(0)
+    if cache is not None:
+        cache.put(replication_seq, tmp)
+    return tmp
+
+
+def open_local_packet(path, replication_seq):
+    fp = PacketCache(path).open(replication_seq, required=False)
+    if fp is not None:
+        print "Opening", fp.name
+    return fp
+
+
+class PacketPrefetcher(object):
+    # Downloads the following packets in a background thread, keeping at most
+    # `depth` of them waiting. The thread stops after the first missing packet
+    # or error, which are passed to the consumer in order.
+
+    def __init__(self, fetch, replication_seq, depth):
+        self._fetch = fetch
+        self._queue = Queue.Queue(depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(replication_seq,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, replication_seq):
+        while not self._stopped.is_set():
+            try:
+                tmp = self._fetch(replication_seq)
+            except Exception:
+                self._put((replication_seq, None, sys.exc_info()))
+                return
+            self._put((replication_seq, tmp, None))
+            if tmp is None:
+                return
+            replication_seq += 1
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        if item[1] is not None:
+            item[1].close()
+
+    def get(self, replication_seq):
+        seq, tmp, exc_info = self._queue.get()
+        if seq != replication_seq:
+            raise Exception("Expected packet %d, but got %d" % (replication_seq, seq))
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return tmp
+
+    def close(self):
+        self._stopped.set()
+        while True:
+            while True:
+                try:
+                    seq, tmp, exc_info = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if tmp is not None:
+                    tmp.close()
+            if not self._thread.is_alive():
+                break
+            self._thread.join(1)
@@ -1,5 +1,7 @@
 
 class ReplicationHook(object):
+    # Subclasses implement the methods they need, the importer doesn't call
+    # the ones that are not implemented
 
     def __init__(self, cfg, db, schema):
         self.cfg = cfg
@@ -15,6 +17,11 @@ class ReplicationHook(object):
     def after_commit(self):
         pass
 
+    def timing(self, seq, report):
+        # Called with the timing report of each applied packet, the time
+        # spent in the hook methods is in the "hooks" phase
+        pass
+
     def before_delete(self, table, keys):
         pass
 
@@ -33,3 +40,13 @@ class ReplicationHook(object):
     def after_insert(self, table, values):
         pass
 
+    def before_batch(self, table, type, rows):
+        # Called once for a run of changes of the same type ('i', 'u' or 'd')
+        # on one table, before they are applied, with a list of (keys, values)
+        pass
+
+    def after_batch(self, table, type, rows):
+        pass
+
+    def overrides(self, name):
+        return getattr(type(self), name).im_func is not getattr(ReplicationHook, name).im_func
@@ -0,0 +1,107 @@
+import os
+import re
+import glob
+from mbslave import parse_name, fqn
+
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql')
+
+TABLE_CONSTRAINTS = set(['CONSTRAINT', 'CHECK', 'PRIMARY', 'UNIQUE', 'FOREIGN', 'EXCLUDE', 'LIKE'])
+
+STATEMENT_TOKEN_RE = re.compile(r"--[^\n]*|^\\[^\n]*|'(?:[^']|'')*'|(\$\w*\$).*?\1|;", re.M | re.S)
+
+
+def read_schema_files(pattern):
+    # Yields the default schema and contents of the MusicBrainz SQL files
+    # matching the pattern, including those of the other schemas
+    paths = glob.glob(os.path.join(SQL_DIR, pattern))
+    paths += glob.glob(os.path.join(SQL_DIR, '*', pattern))
+    for path in sorted(paths):
+        sql = open(path).read()
+        match = re.search(r"SET search_path = '?(\w+)", sql)
+        yield match.group(1) if match else 'musicbrainz', sql
+
+
+def qualify_name(config, default_schema, name):
+    if '.' not in name:
+        name = default_schema + '.' + name
+    return fqn(*parse_name(config, name))
+
+
+def load_tables(config):
+    tables = set()
+    for default_schema, sql in read_schema_files('CreateTables.sql'):
+        for name in re.findall(r'CREATE TABLE\s+([\w.]+)', sql):
+            tables.add(qualify_name(config, default_schema, name))
+    return tables
+
+
+def load_table_columns(config):
+    # Returns the column names of the tables, in the order of the dumps
+    tables = {}
+    for default_schema, sql in read_schema_files('CreateTables.sql'):
+        sql = re.sub(r"--[^\n]*|'(?:[^']|'')*'", lambda m: '' if m.group(0).startswith('--') else "''", sql)
+        for match in re.finditer(r'CREATE TABLE\s+([\w.]+)\s*\(', sql):
+            # Splits the definitions at commas outside of parentheses
+            definitions = []
+            depth = 1
+            start = pos = match.end()
+            while depth:
+                if sql[pos] == '(':
+                    depth += 1
+                elif sql[pos] == ')':
+                    depth -= 1
+                elif sql[pos] == ',' and depth == 1:
+                    definitions.append(sql[start:pos])
+                    start = pos + 1
+                pos += 1
+            definitions.append(sql[start:pos - 1])
+            columns = []
+            for definition in definitions:
+                words = definition.split()
+                if words and words[0].upper() not in TABLE_CONSTRAINTS:
+                    columns.append(words[0])
+            tables[qualify_name(config, default_schema, match.group(1))] = columns
+    return tables
+
+
+def remap_schema(config, line):
+    # Replaces the schema names in a line of SQL with the configured ones
+
+    def update_search_path(m):
+        schemas = m.group(2).replace("'", '').split(',')
+        schemas = [config.schema.name(s.strip()) for s in schemas]
+        return m.group(1) + ', '.join(schemas) + ';'
+
+    def update_schema(m):
+        return m.group(1) + config.schema.name(m.group(2)) + m.group(3)
+
+    line = re.sub(r'(SET search_path = )(.+?);', update_search_path, line)
+    line = re.sub(r'(\b)(\w+)(\.)', update_schema, line)
+    line = re.sub(r'( SCHEMA )(\w+)(;)', update_schema, line)
+    return line
+
+
+def split_statements(sql):
+    # Splits SQL into statements, leaving out comments and psql commands,
+    # semicolons in quoted strings and function bodies are skipped
+    statements = []
+    parts = []
+    pos = 0
+    for match in STATEMENT_TOKEN_RE.finditer(sql):
+        token = match.group(0)
+        if token.startswith('--') or token.startswith('\\'):
+            parts.append(sql[pos:match.start()])
+            pos = match.end()
+        elif token == ';':
+            parts.append(sql[pos:match.start()])
+            pos = match.end()
+            statement = ''.join(parts).strip()
+            if statement:
+                statements.append(statement)
+            parts = []
+    parts.append(sql[pos:])
+    statement = ''.join(parts).strip()
+    if statement:
+        statements.append(statement)
+    return statements
@@ -1,6 +1,10 @@
+import os
+import re
+import json
 import itertools
-from collections import namedtuple
-from lxml.builder import E
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from mbslave import connect_db
 
 Entity = namedtuple('Entity', ['name', 'fields'])
 Field = namedtuple('Field', ['name', 'column'])
@@ -137,6 +141,9 @@ schema = Schema([
 ])
 
 
+# Characters that can't be represented in XML 1.0
+INVALID_XML_CHARS_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
 SQL_SELECT_TPL = "SELECT\n%(columns)s\nFROM\n%(joins)s\nORDER BY %(sort_column)s"
 
 
@@ -234,20 +241,137 @@ def generate_triggers():
 
 
 
-def generate_iter_query(columns, joins, ids=()):
+def generate_iter_query(columns, joins, ids=(), id_range=None):
     id_column = columns[0]
     tpl = ["SELECT", "%(columns)s", "FROM", "%(joins)s"]
     if ids:
-        tpl.append("WHERE %(id_column)s IN (%(ids)s)")
+        tpl.append("WHERE %(id_column)s = ANY(%%s)")
+    elif id_range:
+        tpl.append("WHERE %(id_column)s >= %%s AND %(id_column)s < %%s")
     tpl.append("ORDER BY %(id_column)s")
     sql_columns = ',\n'.join('  ' + i for i in columns)
     sql_joins = '\n'.join('  ' + i for i in joins)
-    sql = "\n".join(tpl) % dict(columns=sql_columns, joins=sql_joins,
-                                id_column=id_column, ids=placeholders(ids))
+    sql = "\n".join(tpl) % dict(columns=sql_columns, joins=sql_joins, id_column=id_column)
     return sql
 
 
-def iter_main(db, kind, ids=()):
+def query_params(ids, id_range):
+    if ids:
+        return [list(ids)]
+    return list(id_range or ())
+
+
+def iter_fields(names, values):
+    # Yields (name, value) pairs of the non-empty values as unicode strings
+    for name, value in zip(names, values):
+        if not value:
+            continue
+        if isinstance(value, str):
+            value = value.decode('utf8')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        if INVALID_XML_CHARS_RE.search(value):
+            continue # XXX
+        yield name, value
+
+
+def escape_xml(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace('\r', '&#13;')
+
+
+class XMLDocumentWriter(object):
+    # Serializes documents and update commands in the Solr XML format
+
+    name = 'xml'
+    content_type = 'application/xml; charset=UTF-8'
+    export_start = '<add>\n'
+    export_separator = '\n'
+    export_end = '\n</add>\n'
+
+    def doc(self, fields):
+        parts = [u'<doc>']
+        for name, value in fields:
+            parts.append(u'<field name="%s">%s</field>' % (name, escape_xml(value)))
+        parts.append(u'</doc>')
+        return u''.join(parts).encode('utf8')
+
+    def add(self, fields):
+        return '<add>%s</add>' % self.doc(fields)
+
+    def delete(self, id):
+        return '<delete><id>%s</id></delete>' % escape_xml(id)
+
+    def update(self, commands):
+        return '<update>\n%s\n</update>\n' % '\n'.join(commands)
+
+    def commit(self):
+        return '<commit/>'
+
+
+class JSONDocumentWriter(object):
+    # Serializes documents and update commands in the Solr JSON format,
+    # fields with more values are written as arrays
+
+    name = 'json'
+    content_type = 'application/json; charset=UTF-8'
+    export_start = '[\n'
+    export_separator = ',\n'
+    export_end = '\n]\n'
+
+    def doc(self, fields):
+        doc = OrderedDict()
+        for name, value in fields:
+            if name not in doc:
+                doc[name] = value
+            elif isinstance(doc[name], list):
+                doc[name].append(value)
+            else:
+                doc[name] = [doc[name], value]
+        return json.dumps(doc, separators=(',', ':'))
+
+    def add(self, fields):
+        return '"add":{"doc":%s}' % self.doc(fields)
+
+    def delete(self, id):
+        return '"delete":{"id":%s}' % json.dumps(id)
+
+    def update(self, commands):
+        # Solr allows repeated keys in the object with update commands
+        return '{\n%s\n}\n' % ',\n'.join(commands)
+
+    def commit(self):
+        return '{"commit":{}}'
+
+
+DOCUMENT_WRITERS = {
+    'xml': XMLDocumentWriter,
+    'json': JSONDocumentWriter,
+}
+
+
+def document_writer(cfg):
+    if cfg.solr.format not in DOCUMENT_WRITERS:
+        raise ValueError("unknown Solr document format %r" % cfg.solr.format)
+    return DOCUMENT_WRITERS[cfg.solr.format]()
+
+
+def write_export(fp, writer, chunks):
+    # Writes the serialized documents as one file that can be posted to Solr
+    fp.write(writer.export_start)
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not first:
+            fp.write(writer.export_separator)
+        fp.write(chunk)
+        first = False
+    fp.write(writer.export_end)
+
+
+def main_query_parts(kind):
+    # Returns the columns and joins of the query reading the single fields
+    # of the entity, with the id as the first column, and the field names
     entity = schema[kind]
     joins = [kind]
     tables = set([kind])
@@ -267,29 +391,29 @@ def iter_main(db, kind, ids=()):
             column = column.foreign
         columns.append('%s.%s' % (table, column.name))
         names.append(field.name)
+    return columns, joins, names
+
 
-    query = generate_iter_query(columns, joins, ids)
+def iter_main(db, kind, ids=(), id_range=None):
+    columns, joins, names = main_query_parts(kind)
+    query = generate_iter_query(columns, joins, ids, id_range)
     cursor = db.cursor('cursor_' + kind)
     cursor.itersize = 100 * 1000
-    cursor.execute(query, ids)
-    for row in cursor:
-        id = row[0]
-        fields = [E.field(kind, name='kind'), E.field('%s:%s' % (kind, id), name='id')]
-        for name, value in zip(names, row[1:]):
-            if not value:
-                continue
-            if isinstance(value, str):
-                value = value.decode('utf8')
-            elif not isinstance(value, unicode):
-                value = unicode(value)
-            try:
-                fields.append(E.field(value, name=name))
-            except ValueError:
-                continue # XXX
-        yield id, fields
-
-
-def iter_sub(db, kind, subtable, ids=()):
+    try:
+        cursor.execute(query, query_params(ids, id_range))
+        for row in cursor:
+            id = row[0]
+            fields = [('kind', kind), ('id', u'%s:%s' % (kind, id))]
+            fields.extend(iter_fields(names, row[1:]))
+            yield id, fields
+    finally:
+        cursor.close()
+
+
+def sub_query_parts(kind, subtable):
+    # Returns the columns and joins of the query reading the multi fields
+    # stored in the subtable, with the id of the entity as the first column,
+    # and the field names
     entity = schema[kind]
     joins = []
     tables = set()
@@ -321,37 +445,66 @@ def iter_sub(db, kind, subtable, ids=()):
             column = column.foreign
         columns.append('%s.%s' % (table, column.name))
         names.append(field.name)
+    return columns, joins, names
+
 
-    query = generate_iter_query(columns, joins, ids)
+def iter_sub(db, kind, subtable, ids=(), id_range=None):
+    columns, joins, names = sub_query_parts(kind, subtable)
+    query = generate_iter_query(columns, joins, ids, id_range)
     cursor = db.cursor('cursor_' + kind + '_' + subtable)
     cursor.itersize = 100 * 1000
-    cursor.execute(query, ids)
-    fields = []
-    last_id = None
-    for row in cursor:
-        id = row[0]
-        if last_id != id:
-            if fields:
-                yield last_id, fields
-            last_id = id
-            fields = []
-        for name, value in zip(names, row[1:]):
-            if not value:
-                continue
-            if isinstance(value, str):
-                value = value.decode('utf8')
-            elif not isinstance(value, unicode):
-                value = unicode(value)
-            try:
-                fields.append(E.field(value, name=name))
-            except ValueError:
-                continue # XXX
-    if fields:
-        yield last_id, fields
-
-
-def placeholders(ids):
-    return ", ".join(["%s" for i in ids])
+    try:
+        cursor.execute(query, query_params(ids, id_range))
+        fields = []
+        last_id = None
+        for row in cursor:
+            id = row[0]
+            if last_id != id:
+                if fields:
+                    yield last_id, fields
+                last_id = id
+                fields = []
+            fields.extend(iter_fields(names, row[1:]))
+        if fields:
+            yield last_id, fields
+    finally:
+        cursor.close()
+
+
+def iter_lateral(db, kind, ids=(), id_range=None):
+    # Reads each entity as one row, the values from each subtable are
+    # collected into arrays by a LATERAL subquery. The arrays of one subtable
+    # are aggregated from the same rows, so they can be zipped back together.
+    columns, joins, names = main_query_parts(kind)
+    groups = []
+    for subtable in iter_subtables(kind):
+        sub_columns, sub_joins, sub_names = sub_query_parts(kind, subtable)
+        label = subtable + '__values'
+        values = ['array_agg(%s::text) AS v%d' % (column, i) for i, column in enumerate(sub_columns[1:])]
+        joins.append('CROSS JOIN LATERAL (SELECT %(values)s FROM %(joins)s WHERE %(backref)s = %(kind)s.id) AS %(label)s' % dict(
+            values=', '.join(values), joins=' '.join(sub_joins), backref=sub_columns[0], kind=kind, label=label))
+        columns.extend('%s.v%d' % (label, i) for i in range(len(values)))
+        groups.append((len(values), sub_names))
+
+    query = generate_iter_query(columns, joins, ids, id_range)
+    cursor = db.cursor('cursor_' + kind + '_lateral')
+    cursor.itersize = 10 * 1000
+    try:
+        cursor.execute(query, query_params(ids, id_range))
+        for row in cursor:
+            id = row[0]
+            fields = [('kind', kind), ('id', u'%s:%s' % (kind, id))]
+            fields.extend(iter_fields(names, row[1:len(names) + 1]))
+            pos = len(names) + 1
+            for count, sub_names in groups:
+                # array_agg returns NULL instead of an empty array
+                arrays = [values or [] for values in row[pos:pos + count]]
+                pos += count
+                for values in zip(*arrays):
+                    fields.extend(iter_fields(sub_names, values))
+            yield id, fields
+    finally:
+        cursor.close()
 
 
 def grab_next(iter):
@@ -362,23 +515,41 @@ def grab_next(iter):
 
 
 def merge(main, *extra):
-    current = map(grab_next, extra)
-    for id, fields in main:
-        for i, extra_item in enumerate(current):
-            if extra_item is not None:
-                if extra_item[0] == id:
-                    fields.extend(extra_item[1])
-                    current[i] = grab_next(extra[i])
-        yield id, E.doc(*fields)
-
-
-def fetch_entities(db, kind, ids=()):
-    sources = [iter_main(db, kind, ids)]
+    try:
+        current = map(grab_next, extra)
+        for id, fields in main:
+            for i, extra_item in enumerate(current):
+                if extra_item is not None:
+                    if extra_item[0] == id:
+                        fields.extend(extra_item[1])
+                        current[i] = grab_next(extra[i])
+            yield id, fields
+    finally:
+        # The subtables are not always read to the end, closing the
+        # generators closes their cursors
+        for source in (main,) + extra:
+            source.close()
+
+
+def iter_subtables(kind):
     subtables = set()
     for field in schema[kind].iter_multi_fields():
         if field.column.table not in subtables:
-            sources.append(iter_sub(db, kind, field.column.table, ids))
+            yield field.column.table
             subtables.add(field.column.table)
+
+
+def fetch_entities(db, kind, ids=(), id_range=None, query='merge'):
+    # With query=merge, the main table and each subtable are read by separate
+    # queries sorted by the id and merged here, with query=lateral all fields
+    # come from a single query
+    if query == 'lateral':
+        return iter_lateral(db, kind, ids, id_range)
+    if query != 'merge':
+        raise ValueError("unknown Solr query strategy %r" % query)
+    sources = [iter_main(db, kind, ids, id_range)]
+    for subtable in iter_subtables(kind):
+        sources.append(iter_sub(db, kind, subtable, ids, id_range))
     return merge(*sources)
 
 
@@ -410,32 +581,128 @@ def fetch_works(db, ids=()):
     return fetch_entities(db, 'work', ids)
 
 
+KINDS = ['artist', 'label', 'place', 'recording', 'release_group', 'release', 'work']
+
+
 def fetch_all(cfg, db):
-    return itertools.chain(
-        fetch_artists(db) if cfg.solr.index_artists else [],
-        fetch_labels(db) if cfg.solr.index_labels else [],
-        fetch_places(db) if cfg.solr.index_places else [],
-        fetch_recordings(db) if cfg.solr.index_recordings else [],
-        fetch_release_groups(db) if cfg.solr.index_release_groups else [],
-        fetch_releases(db) if cfg.solr.index_releases else [],
-        fetch_works(db) if cfg.solr.index_works else [])
+    return itertools.chain(*[fetch_entities(db, kind, query=cfg.solr.query)
+                             for kind in KINDS if getattr(cfg.solr, 'index_%ss' % kind)])
 
 
-def fetch_all_updated(cfg, db):
-    queue = cfg.schema.name("mbslave") + ".mbslave_solr_queue"
-    updated = {}
+def split_id_ranges(cfg, db, range_size):
+    # Splits the enabled entity kinds into ranges of ids, in the order of fetch_all
     cursor = db.cursor()
-    cursor.execute("SELECT id, entity_type, entity_id FROM " + queue)
-    for id, kind, entity_id in cursor:
-        if kind not in updated:
-            updated[kind] = set()
-        db.cursor().execute("DELETE FROM " + queue + " WHERE id = %s", (id,))
-        updated[kind].add(entity_id)
-    for kind, ids in updated.iteritems():
-        if getattr(cfg.solr, 'index_%ss' % kind):
-            missing = set(ids)
-            for id, doc in fetch_entities(db, kind, list(ids)):
-                missing.remove(id)
-                yield E.add(doc)
-            if missing:
-                yield E.delete(*map(E.id, ['%s:%s' % (kind, id) for id in missing]))
+    ranges = []
+    for kind in KINDS:
+        if not getattr(cfg.solr, 'index_%ss' % kind):
+            continue
+        cursor.execute("SELECT min(id), max(id) FROM %s.%s" % (cfg.schema.name('musicbrainz'), kind))
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            continue
+        for start in xrange(min_id, max_id + 1, range_size):
+            ranges.append((kind, start, min(start + range_size, max_id + 1)))
+    return ranges
+
+
+_export_db = None
+_export_dir = None
+_export_writer = None
+_export_query = None
+
+
+def init_export_worker(cfg, snapshot, output_dir, writer):
+    # Each worker reads from the snapshot of the main connection, so all
+    # ranges see the same state of the database
+    global _export_db, _export_dir, _export_writer, _export_query
+    _export_dir = output_dir
+    _export_writer = writer
+    _export_query = cfg.solr.query
+    _export_db = connect_db(cfg)
+    _export_db.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = _export_db.cursor()
+    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+    cursor.execute("SET search_path TO %s", (cfg.schema.name('musicbrainz'),))
+
+
+def export_range(task):
+    kind, start, end = task
+    docs = [_export_writer.doc(fields) for id, fields in fetch_entities(_export_db, kind, id_range=(start, end), query=_export_query)]
+    if _export_dir is None:
+        return _export_writer.export_separator.join(docs)
+    path = os.path.join(_export_dir, '%s-%010d.%s' % (kind, start, _export_writer.name))
+    with open(path, 'w') as fp:
+        write_export(fp, _export_writer, docs)
+    return path
+
+
+def export_parallel(cfg, workers, range_size=100000, output_dir=None, writer=None):
+    # Exports the documents using a pool of processes, each entity kind is
+    # split into ranges of ids. Yields the serialized documents of each range
+    # in the order of fetch_all, or if output_dir is set, writes each range
+    # to a separate file there and yields the file names as they are done.
+    db = connect_db(cfg)
+    db.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        cursor = db.cursor()
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        ranges = split_id_ranges(cfg, db, range_size)
+        pool = multiprocessing.Pool(workers, init_export_worker, (cfg, snapshot, output_dir, writer or XMLDocumentWriter()))
+        try:
+            if output_dir is None:
+                results = pool.imap(export_range, ranges)
+            else:
+                results = pool.imap_unordered(export_range, ranges)
+            for result in results:
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        db.close()
+
+
+def fetch_updated_entities(cfg, db, kind, ids, writer):
+    # Yields the update commands for the given entities, adding the ones
+    # that exist and deleting the rest
+    missing = set(ids)
+    for id, fields in fetch_entities(db, kind, ids, query=cfg.solr.query):
+        missing.discard(id)
+        yield writer.add(fields)
+    for id in sorted(missing):
+        yield writer.delete('%s:%s' % (kind, id))
+
+
+def fetch_updated_chunks(cfg, db, chunk_size=10000, writer=None):
+    # Removes at most chunk_size entries at a time from the queue and yields
+    # the update commands for each chunk, so the caller can commit the
+    # transaction once they were applied. Rows locked by another process
+    # draining the queue are skipped.
+    queue = cfg.schema.name("mbslave") + ".mbslave_solr_queue"
+    if writer is None:
+        writer = XMLDocumentWriter()
+    while True:
+        cursor = db.cursor()
+        cursor.execute("""
+            WITH deleted AS (
+                DELETE FROM %(queue)s WHERE id IN (
+                    SELECT id FROM %(queue)s ORDER BY id LIMIT %%s FOR UPDATE SKIP LOCKED)
+                RETURNING entity_type, entity_id)
+            SELECT entity_type, array_agg(DISTINCT entity_id) FROM deleted GROUP BY entity_type
+        """ % dict(queue=queue), (chunk_size,))
+        updated = cursor.fetchall()
+        if not updated:
+            break
+        commands = []
+        for kind, ids in updated:
+            if getattr(cfg.solr, 'index_%ss' % kind):
+                commands.append(fetch_updated_entities(cfg, db, kind, ids, writer))
+        yield itertools.chain(*commands)
+
+
+def fetch_all_updated(cfg, db, writer=None):
+    for commands in fetch_updated_chunks(cfg, db, cfg.solr.queue_chunk_size, writer):
+        for command in commands:
+            yield command
@@ -0,0 +1,54 @@
+import json
+import socket
+import httplib
+import urlparse
+
+
+class SolrError(Exception):
+    pass
+
+
+class SolrClient(object):
+    # Posts updates to Solr, reusing one keep-alive connection. The commands
+    # are serialized by a document writer from mbslave.search.
+
+    def __init__(self, url, writer, timeout=600):
+        url = urlparse.urlsplit(url)
+        if url.scheme == 'https':
+            self.conn = httplib.HTTPSConnection(url.netloc, timeout=timeout)
+        else:
+            self.conn = httplib.HTTPConnection(url.netloc, timeout=timeout)
+        self.path = url.path.rstrip('/') + '/update?wt=json'
+        self.writer = writer
+
+    def post(self, body):
+        headers = {'Content-Type': self.writer.content_type}
+        for attempt in range(2):
+            try:
+                self.conn.request('POST', self.path, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server might have closed the idle connection, updates
+                # can be safely sent again
+                self.conn.close()
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise SolrError("Solr returned HTTP status %d: %s" % (response.status, data))
+        try:
+            status = json.loads(data)['responseHeader']['status']
+        except (ValueError, KeyError, TypeError):
+            raise SolrError("Unexpected response from Solr: %s" % data)
+        if status != 0:
+            raise SolrError("Solr update failed: %s" % data)
+
+    def update(self, commands):
+        self.post(self.writer.update(commands))
+
+    def commit(self):
+        self.post(self.writer.commit())
+
+    def close(self):
+        self.conn.close()
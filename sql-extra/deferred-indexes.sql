@@ -0,0 +1,8 @@
+CREATE TABLE mbslave_deferred_index (
+    schema_name text NOT NULL,
+    index_name text NOT NULL,
+    definition text NOT NULL,
+    deferred timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (schema_name, index_name)
+);
+